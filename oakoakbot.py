@@ -1,28 +1,98 @@
 import argparse
 import asyncio
+import io
+import multiprocessing
 import os
 import random
-import string
+import signal
+import sys
 import time
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.handler import CancelHandler
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import SendMessage
+from aiogram.utils import executor
+from aiogram.utils.callback_data import CallbackData
+from aiogram.utils.exceptions import BadRequest, MessageNotModified
 
+from oakoakbot.chat_locks import ChatLocks
 from oakoakbot.db import (
+    ActiveEncounters,
     Pokemon,
     CaughtPokemon,
     GroupsConfiguration,
     PokemonNatures,
     WildEncounter,
+    db_executor,
+    init_database,
+    load_spawn_table,
+    name_index,
+    write_queue,
 )
+from oakoakbot.images import sprite_cache
 from oakoakbot.logger import get_logger
+from oakoakbot.metrics import (
+    catches,
+    current_trace,
+    flees,
+    handler_seconds,
+    registry,
+    spawns,
+    start_metrics_server,
+)
+from oakoakbot.send_scheduler import (
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    SendScheduler,
+    TokenBucket,
+)
+from oakoakbot.sharding import consume_updates, get_shard, ingest_updates
+from oakoakbot.throttle import SlidingWindowLimiter
+from oakoakbot.timer_wheel import TimerWheel
 
 logger = get_logger()
 
-bot = Bot(token=os.environ["BOT_TOKEN"])
+# Placeholder token for the actions that never call the Bot API, such as
+# check-performance, so they can run without a BOT_TOKEN
+OFFLINE_BOT_TOKEN = "0:offline"
+
+bot = Bot(token=os.environ.get("BOT_TOKEN", OFFLINE_BOT_TOKEN))
 dispatcher = Dispatcher(bot=bot)
 
+# Webhook mode settings. Telegram posts updates to WEBHOOK_URL + the webhook path,
+# which ends with WEBHOOK_SECRET so that only Telegram knows where to post them.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+
+# Telegram's flood limits: messages per second overall and per group chat
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", 20 / 60))
+SEND_CHAT_BURST = int(os.environ.get("SEND_CHAT_BURST", 3))
+
+# /catch attempts allowed per user and group within CATCH_WINDOW seconds. Users going
+# over it are ignored for CATCH_COOLDOWN seconds.
+CATCH_LIMIT = int(os.environ.get("CATCH_LIMIT", 10))
+CATCH_WINDOW = float(os.environ.get("CATCH_WINDOW", 60))
+CATCH_COOLDOWN = float(os.environ.get("CATCH_COOLDOWN", 30))
+THROTTLE_MAX_KEYS = int(os.environ.get("THROTTLE_MAX_KEYS", 65536))
+
+# Metrics are served on http://METRICS_HOST:METRICS_PORT/metrics, unless the port is 0.
+# Sharded workers use the following ports, one each. If TRACE_UPDATES_MS is set, the
+# timings of every update taking at least that many milliseconds are logged.
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))
+TRACE_UPDATES_MS = os.environ.get("TRACE_UPDATES_MS")
+
 POKEMON_TIMEOUT = 120
+# Wild Pokemon fleeing at once, so a tick with many expired chats doesn't flood the
+# event loop with lock waiters and database writes
+MAX_CONCURRENT_FLEES = 32
+TEAM_PAGE_SIZE = 50
 SHINY_CHANCE = 1 / 10000
 RARITY_TIERS = {
     "ultra-rare": 0.025,
@@ -32,55 +102,152 @@ RARITY_TIERS = {
 }
 
 wild_encounters = {}
+# Spawns, catches and flees of a chat run one at a time, in the order they arrive
+chat_locks = ChatLocks()
+send_scheduler = SendScheduler(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST)
+background_tasks = []
+metrics_servers = []
+team_page_callback = CallbackData("showteam", "user_id", "slot", "backwards")
 
 
 def pokemon_names_are_equivalent(pokemon_guess: str, wild_encounter: WildEncounter):
     """Compare if two strings containing pokemon names are equal enough for the pokemon
     to be considered caught
     """
-    pokemon_guess = pokemon_guess.lower()
-    wild_pokemon_name = wild_encounter.pokemon.name.lower()
-
-    # Allow both adding and not adding the region name
-    for region in ["alolan", "galarian"]:
-        if wild_encounter.pokemon.region == region:
-            if (
-                pokemon_guess.startswith(region)
-                or pokemon_guess.startswith(region[:-1])
-                or pokemon_guess.endswith(region)
-                or pokemon_guess.endswith(region[:-1])
-            ):
-                pokemon_guess = pokemon_guess.replace(region, "")
-                pokemon_guess = pokemon_guess.replace(region[:-1], "")
-
-    # Allow both adding and not adding gender
-    if wild_pokemon_name.endswith(" m"):
-        pokemon_guess = pokemon_guess.replace(" male", "").replace("male ", "")
-        pokemon_guess = pokemon_guess.replace(" m", "") + " m"
-    if wild_pokemon_name.endswith(" f"):
-        pokemon_guess = pokemon_guess.replace(" female", "").replace(" female", "")
-        pokemon_guess = pokemon_guess.replace(" f", "") + " f"
-
-    # Remove spaces and punctuations from both strings
-    trans_table = str.maketrans("", "", string.punctuation + " ")
-    pokemon_guess = pokemon_guess.translate(trans_table)
-    wild_pokemon_name = wild_pokemon_name.translate(trans_table)
-
-    return pokemon_guess == wild_pokemon_name
+    return name_index.matches(pokemon_guess, wild_encounter.pokemon)
+
+
+async def expire_wild_encounter(chat_id, now):
+    async with chat_locks(chat_id):
+        wild_encounter = wild_encounters.get(chat_id)
+        if wild_encounter and now - wild_encounter.release_time >= POKEMON_TIMEOUT:
+            wild_encounters.pop(chat_id)
+            flees.inc()
+            await ActiveEncounters.forget_encounter_async(chat_id)
+            # Not awaited, so a rate limited chat doesn't hold its lock or delay the
+            # flees of other chats. The scheduler logs the failures.
+            send_scheduler.send(
+                chat_id, bot.send_message, chat_id, f"Oh no! the wild pokemon fled!"
+            )
+
+
+async def expire_wild_encounters(chat_ids):
+    """Make the wild Pokemon of the given chats flee. Called by `encounter_timers`"""
+    now = time.time()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FLEES)
+
+    async def expire(chat_id):
+        async with semaphore:
+            await expire_wild_encounter(chat_id, now)
+
+    expirations = [expire(chat_id) for chat_id in chat_ids]
+    results = await asyncio.gather(*expirations, return_exceptions=True)
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Couldn't forget the wild Pokemon of {chat_id}: {result}")
+
+
+encounter_timers = TimerWheel(POKEMON_TIMEOUT, expire_wild_encounters)
+
+
+def reply(event: types.Message, text, **kwargs):
+    """Build a text answer to a message for a handler to return. On webhooks it's sent
+    inside the webhook response, saving an API call, and when polling aiogram sends
+    it right after the handler returns. If the chat is over its flood limit, the
+    answer is queued on the send scheduler instead.
+    """
+    if send_scheduler.try_acquire(event.chat.id):
+        return SendMessage(event.chat.id, text, **kwargs)
+    send_scheduler.send_message(event.chat.id, event.answer, text, **kwargs)
+
+
+async def answer_sprite(
+    event: types.Message, sprite_name, caption, priority=PRIORITY_NORMAL, **kwargs
+):
+    """Answer with a sprite, reusing the Telegram file_id of previous uploads of the
+    same sprite instead of uploading its bytes again.
+    """
+    if (file_id := sprite_cache.get_file_id(sprite_name)) is not None:
+        try:
+            return await send_scheduler.send(
+                event.chat.id,
+                event.answer_photo,
+                file_id,
+                caption,
+                priority=priority,
+                **kwargs,
+            )
+        except BadRequest:
+            logger.warning(f"Cached file_id of {sprite_name} was rejected")
+            sprite_cache.forget_file_id(sprite_name)
+
+    image = sprite_cache.get(sprite_name)
+    photo = types.InputFile(io.BytesIO(image), os.path.basename(sprite_name))
+    message = await send_scheduler.send(
+        event.chat.id, event.answer_photo, photo, caption, priority=priority, **kwargs
+    )
+    sprite_cache.set_file_id(sprite_name, message.photo[-1].file_id)
+    return message
 
 
 class GroupCheck(BaseMiddleware):
     def __init__(self) -> None:
-        self.groups = GroupsConfiguration.get_groups()
+        GroupsConfiguration.load_groups()
         super(GroupCheck, self).__init__()
 
     async def on_process_message(self, event, _):
         """Manage the current list of registered groups. Called on every message before
         dispatching them to the handlers.
         """
-        if event.chat.id not in self.groups:
-            GroupsConfiguration.add_group(event.chat.id)
-            self.groups = GroupsConfiguration.get_groups()
+        if await GroupsConfiguration.get_config_async(event.chat.id) is None:
+            await GroupsConfiguration.add_group_async(event.chat.id)
+
+
+class CatchThrottle(BaseMiddleware):
+    def __init__(self) -> None:
+        self.limiter = SlidingWindowLimiter(
+            CATCH_LIMIT, CATCH_WINDOW, CATCH_COOLDOWN, THROTTLE_MAX_KEYS
+        )
+        super(CatchThrottle, self).__init__()
+
+    async def on_process_message(self, event, _):
+        """Silently drop the /catch commands of users going over their limit on a
+        group, before they reach any other middleware or handler.
+        """
+        command = event.get_command(pure=True)
+        if command is None or command.lower() != "catch":
+            return
+        if event.from_user is None:
+            return
+        if not self.limiter.hit((event.from_user.id, event.chat.id)):
+            raise CancelHandler()
+
+
+class UpdateTracer(BaseMiddleware):
+    """Log how long each update took, broken down into the handlers and database
+    queries timed while handling it. Only updates taking at least `threshold_ms`
+    milliseconds are logged.
+    """
+
+    def __init__(self, threshold_ms=0.0) -> None:
+        self.threshold = threshold_ms / 1000
+        super(UpdateTracer, self).__init__()
+
+    async def on_pre_process_update(self, update, data):
+        data["trace"] = current_trace.set([]), time.perf_counter()
+
+    async def on_post_process_update(self, update, _, data):
+        token, t0 = data.pop("trace")
+        elapsed = time.perf_counter() - t0
+        trace = current_trace.get()
+        current_trace.reset(token)
+        if elapsed < self.threshold:
+            return
+        spans = ", ".join(f"{name} {seconds * 1000:.2f}ms" for name, seconds in trace)
+        logger.info(
+            f"Update {update.update_id} took {elapsed * 1000:.2f}ms"
+            + (f": {spans}" if spans else "")
+        )
 
 
 @dispatcher.message_handler(
@@ -88,8 +255,7 @@ class GroupCheck(BaseMiddleware):
     commands=["start", "restart", "help"],
 )
 async def start_handler(event: types.Message):
-    await event.answer("Bot in development.")
-    return
+    return reply(event, "Bot in development.")
     await event.answer(
         f"Hello, {event.from_user.get_mention(as_html=True)} 👋!\n\n"
         f"I'm Professor Oak. I can be added to any group, and if I'm given the "
@@ -106,7 +272,8 @@ async def start_handler(event: types.Message):
     commands=["help"],
 )
 async def help_handler(event: types.Message):
-    await event.answer(
+    return reply(
+        event,
         f"Pokemon will appear randomly\. Catch them to add them to your team\!"
         f"\n\n"
         f"/catch <pokemon name\> \- Catch a wild Pokemon\. Only Pokemon notified "
@@ -120,7 +287,7 @@ async def help_handler(event: types.Message):
         f"this group\. <rate\> must be a float between 0 and 1\. Each message will "
         f"have a chance of <rate\> to spawn a wild Pokemon\."
         f"\n"
-        f"/showteam \- See the Pokemon you've caught on this group\."
+        f"/showteam \[page\] \- See the Pokemon you've caught on this group\."
         f"\n\n\n"
         f"Bugs and suggestions can be reported on oakoakbot's "
         f"[GitHub page](https://github.com/tacochan/oakoakbot)\.",
@@ -137,28 +304,30 @@ async def set_rate_handler(event: types.Message):
     new_rate = event.get_args()
 
     if not new_rate:
-        await event.answer(
+        return reply(
+            event,
             f"You must specify a <rate\> parameter\. Example: `/setrate 0\.01`",
             parse_mode=types.ParseMode.MARKDOWN_V2,
             disable_web_page_preview=True,
         )
-        return
 
     try:
         new_rate = float(new_rate)
         if new_rate < 0 or new_rate > 1:
             raise ValueError
-        GroupsConfiguration.set_pokemon_rate(event.chat.id, new_rate)
+        await GroupsConfiguration.set_pokemon_rate_async(event.chat.id, new_rate)
         logger.info(f"Rate for group {event.chat.id} set to {new_rate}")
 
-        await event.answer(
+        return reply(
+            event,
             f"Pokemon rate was successfully updated",
             parse_mode=types.ParseMode.MARKDOWN_V2,
             disable_web_page_preview=True,
         )
 
     except ValueError:
-        await event.answer(
+        return reply(
+            event,
             f"<rate\> parameter must be a number between 0 and 1\. "
             f"Example: `/setrate 0\.01`",
             parse_mode=types.ParseMode.MARKDOWN_V2,
@@ -174,21 +343,22 @@ async def set_gens_handler(event: types.Message):
     gens = event.get_args()
 
     if not gens:
-        await event.answer(
+        return reply(
+            event,
             f"You must specify a <gens\> parameter\. Example: `/setgens 1,2,3`",
             parse_mode=types.ParseMode.MARKDOWN_V2,
             disable_web_page_preview=True,
         )
-        return
 
     try:
         generations = [int(gen) for gen in gens.split(",")]
         if any([gen > 8 or gen < 0 for gen in generations]):
             raise ValueError
 
-        GroupsConfiguration.set_generations(event.chat.id, generations)
+        await GroupsConfiguration.set_generations_async(event.chat.id, generations)
 
-        await event.answer(
+        return reply(
+            event,
             f"From now on, only Pokemon of generation"
             f"{'s' if len(generations) > 1 else ''} "
             f"{','.join(str(gen) for gen in generations)} will appear.",
@@ -197,7 +367,8 @@ async def set_gens_handler(event: types.Message):
         )
 
     except ValueError:
-        await event.answer(
+        return reply(
+            event,
             f"<gens\> parameter must be a list of numbers on the range \[1,8\] "
             f"separated by commas\. Example: 1,2,3",
             parse_mode=types.ParseMode.MARKDOWN_V2,
@@ -205,68 +376,149 @@ async def set_gens_handler(event: types.Message):
         )
 
 
+async def get_team_page_message(user: types.User, group_id, slot, backwards=False):
+    """Build the text and navigation buttons of a page of a user's team"""
+    page, has_previous, has_next = await CaughtPokemon.get_team_page(
+        user.id, group_id, slot, TEAM_PAGE_SIZE, backwards
+    )
+    if not page:
+        if slot == 0:
+            return f"You still haven't caught any Pokemon!", None
+        return f"You don't have that many Pokemon yet!", None
+
+    answer = f"{user.get_mention(as_html=True)}'s caught Pokemon:\n"
+    for team_pokemon_id, name in page:
+        answer += f"{team_pokemon_id + 1}. {name}\n"
+
+    buttons = []
+    if has_previous:
+        buttons.append(
+            types.InlineKeyboardButton(
+                "⬅️ Previous",
+                callback_data=team_page_callback.new(user.id, page[0][0], 1),
+            )
+        )
+    if has_next:
+        buttons.append(
+            types.InlineKeyboardButton(
+                "Next ➡️",
+                callback_data=team_page_callback.new(user.id, page[-1][0] + 1, 0),
+            )
+        )
+    return answer, types.InlineKeyboardMarkup().row(*buttons) if buttons else None
+
+
 @dispatcher.message_handler(
     chat_type=[types.ChatType.SUPERGROUP, types.ChatType.GROUP], commands=["showteam"]
 )
+@handler_seconds.time
 async def show_team_handler(event: types.Message):
-    pokemon = await CaughtPokemon.get_caught_pokemon(event.from_user.id, event.chat.id)
-    if not len(pokemon):
-        answer = f"You still haven't caught any Pokemon!"
-    else:
-        answer = f"{event.from_user.get_mention(as_html=True)}'s caught Pokemon:\n"
-        for p in pokemon[:50]:
-            answer += f"{p.team_pokemon_id + 1}. {p.pokemon.name}\n"
-        if len(pokemon) > 50:
-            answer += (
-                f"\n\nOnly your first 50 Pokemon can be shown, I'll find a way to fix "
-                f"that (eventually)."
-            )
+    page = event.get_args()
+    page = int(page) if page.isdecimal() and int(page) > 0 else 1
 
-    await event.answer(
+    answer, reply_markup = await get_team_page_message(
+        event.from_user, event.chat.id, (page - 1) * TEAM_PAGE_SIZE
+    )
+    return reply(
+        event,
         answer,
         parse_mode=types.ParseMode.HTML,
         disable_web_page_preview=True,
+        reply_markup=reply_markup,
     )
 
 
+@dispatcher.callback_query_handler(team_page_callback.filter())
+@handler_seconds.time
+async def show_team_page_handler(query: types.CallbackQuery, callback_data: dict):
+    """Handler for the previous/next buttons of the /showteam message"""
+    if query.from_user.id != int(callback_data["user_id"]):
+        await query.answer("You can only browse your own team!")
+        return
+
+    answer, reply_markup = await get_team_page_message(
+        query.from_user,
+        query.message.chat.id,
+        int(callback_data["slot"]),
+        callback_data["backwards"] == "1",
+    )
+    try:
+        await query.message.edit_text(
+            answer,
+            parse_mode=types.ParseMode.HTML,
+            disable_web_page_preview=True,
+            reply_markup=reply_markup,
+        )
+    except MessageNotModified:
+        # Double clicks and stale buttons ask for the page already shown
+        pass
+    await query.answer()
+
+
 @dispatcher.message_handler(
     chat_type=[types.ChatType.SUPERGROUP, types.ChatType.GROUP], commands=["catch"]
 )
+@handler_seconds.time
 async def catch_handler(event: types.Message):
     pokemon_guess = event.get_args()
-    wild_encounter = wild_encounters.get(event.chat.id)
 
-    if wild_encounter and pokemon_names_are_equivalent(pokemon_guess, wild_encounter):
-        caught_pokemon = wild_encounters.pop(event.chat.id)
+    caught = None
+    async with chat_locks(event.chat.id):
+        wild_encounter = wild_encounters.get(event.chat.id)
+        if wild_encounter and pokemon_names_are_equivalent(
+            pokemon_guess, wild_encounter
+        ):
+            wild_encounters.pop(event.chat.id)
+            encounter_timers.cancel(event.chat.id)
+            catches.inc()
 
-        await CaughtPokemon.catch_pokemon(
-            caught_pokemon, event.from_user.id, event.chat.id
-        )
-        if caught_pokemon.shiny:
-            await event.answer_photo(
-                wild_encounter.colour_image,
+            await CaughtPokemon.catch_pokemon(
+                wild_encounter, event.from_user.id, event.chat.id
+            )
+            caught = wild_encounter
+
+    # Confirmed once the lock is released, so the group doesn't wait for the photo
+    if caught is not None:
+        if caught.shiny:
+            await answer_sprite(
+                event,
+                caught.colour_sprite,
                 f"AWESOME! {event.from_user.get_mention(as_html=True)} caught a "
-                f"<b>shiny {wild_encounter.pokemon.name}</b>!",
+                f"<b>shiny {caught.pokemon.name}</b>!",
+                priority=PRIORITY_HIGH,
                 parse_mode=types.ParseMode.HTML,
             )
-
         else:
-            await event.answer_photo(
-                wild_encounter.colour_image,
+            await answer_sprite(
+                event,
+                caught.colour_sprite,
                 f"Congratulations {event.from_user.get_mention(as_html=True)}! "
-                f"{wild_encounter.pokemon.name} was caught!",
+                f"{caught.pokemon.name} was caught!",
+                priority=PRIORITY_HIGH,
                 parse_mode=types.ParseMode.HTML,
             )
-    elif pokemon_guess in ["oak", "professor oak", "samuel oak"]:
-        await event.answer(
+        return
+
+    if pokemon_guess in ["oak", "professor oak", "samuel oak"]:
+        return reply(
+            event,
             f"Hey! I'm not yours to catch!",
         )
     elif pokemon_guess:
-        await event.answer(
-            f"Hm no, I haven't seen any wild {pokemon_guess}",
+        answer = f"Hm no, I haven't seen any wild {pokemon_guess}"
+        if suggestion := name_index.suggest(pokemon_guess):
+            answer += f". Did you mean {suggestion}?"
+        # Wrong guesses go last, and bursts of them are sent as a single message
+        send_scheduler.send_message(
+            event.chat.id,
+            event.answer,
+            answer,
+            priority=PRIORITY_LOW,
+            coalesce="wrong_guess",
         )
     else:
-        await event.answer(
+        return reply(
+            event,
             f"You must tell me which pokemon you want to catch",
         )
 
@@ -274,45 +526,209 @@ async def catch_handler(event: types.Message):
 @dispatcher.message_handler(
     chat_type=[types.ChatType.SUPERGROUP, types.ChatType.GROUP],
 )
+@handler_seconds.time
 async def message_handler(event: types.Message):
     """Handler called every time a message is sent to a group and it's not a command.
     It rolls a random and if it's under the group's pokemon rate it spawns a pokemon.
     """
+    # Cheap check without locking, most messages arrive while a Pokemon is out
     if event.chat.id in wild_encounters:
-        if time.time() - wild_encounters[event.chat.id].release_time > POKEMON_TIMEOUT:
-            wild_encounters.pop(event.chat.id)
-            await event.answer(
-                f"Oh no! the wild pokemon fled!",
-            )
-    elif (r := random.random()) < GroupsConfiguration.get_pokemon_rate(event.chat.id):
+        return
+
+    async with chat_locks(event.chat.id):
+        if event.chat.id in wild_encounters:
+            return
+
+        group_config = await GroupsConfiguration.get_config_async(event.chat.id)
+        if (r := random.random()) >= group_config.pokemon_rate:
+            return
+
         shiny = r < SHINY_CHANCE
         rarity = next(tier for tier, chance in RARITY_TIERS.items() if r < chance)
-        generations = GroupsConfiguration.get_generations(event.chat.id)
-        wild_encounter = Pokemon.get_random_encounter(generations, rarity, shiny)
+        wild_encounter = Pokemon.get_random_encounter(
+            group_config.generations, rarity, shiny
+        )
         wild_encounters[event.chat.id] = wild_encounter
+        spawns.inc()
+        encounter_timers.schedule(
+            event.chat.id, wild_encounter.release_time + POKEMON_TIMEOUT
+        )
 
-        await event.answer_photo(
-            wild_encounter.silhouette_image,
-            f"A wild pokemon appeared!",
+        await asyncio.gather(
+            answer_sprite(
+                event,
+                wild_encounter.silhouette_sprite,
+                f"A wild pokemon appeared!",
+            ),
+            ActiveEncounters.save_encounter_async(event.chat.id, wild_encounter),
         )
+        sprite_cache.prefetch(wild_encounter.colour_sprite)
         logger.info(f"{wild_encounter.pokemon.name} released on group {event.chat.id}")
 
 
+def restore_wild_encounters(shard=None):
+    """Bring back the wild Pokemon that were out when the bot stopped, unless they
+    should have fled already. With `shard`, as (index, count), only the ones of the
+    chats owned by that shard.
+    """
+    for chat_id, wild_encounter in ActiveEncounters.load_encounters(
+        POKEMON_TIMEOUT
+    ).items():
+        if shard is not None and get_shard(chat_id, shard[1]) != shard[0]:
+            continue
+        wild_encounters[chat_id] = wild_encounter
+        deadline = wild_encounter.release_time + POKEMON_TIMEOUT
+        encounter_timers.schedule(chat_id, deadline)
+    logger.info(f"Restored {len(wild_encounters)} wild Pokemon.")
+
+
+async def on_startup(dispatcher: Dispatcher, shard=None):
+    load_spawn_table()
+    restore_wild_encounters(shard)
+    background_tasks.append(asyncio.ensure_future(encounter_timers.run()))
+    if METRICS_PORT:
+        # Shard workers serve their own metrics on the ports following METRICS_PORT
+        port = METRICS_PORT + (shard[0] + 1 if shard is not None else 0)
+        try:
+            metrics_servers.append(
+                await start_metrics_server(registry, METRICS_HOST, port)
+            )
+        except OSError as e:
+            logger.warning(f"Couldn't serve metrics on {METRICS_HOST}:{port}: {e}")
+    if TRACE_UPDATES_MS is not None:
+        dispatcher.middleware.setup(UpdateTracer(float(TRACE_UPDATES_MS)))
+    dispatcher.middleware.setup(CatchThrottle())
+    dispatcher.middleware.setup(GroupCheck())
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    for runner in metrics_servers:
+        await runner.cleanup()
+    metrics_servers.clear()
+    await send_scheduler.close()
+    await sprite_cache.close()
+    await write_queue.close()
+    db_executor.shutdown()
+
+
 async def start():
     try:
+        await on_startup(dispatcher)
         logger.info("Waiting for messages...")
-        dispatcher.middleware.setup(GroupCheck())
         await dispatcher.start_polling()
     finally:
+        await on_shutdown(dispatcher)
         await bot.close()
 
 
+async def start_worker(queue, shard, num_shards):
+    # The global flood limit is shared by all the workers
+    send_scheduler.global_bucket = TokenBucket(
+        SEND_GLOBAL_RATE / num_shards, SEND_GLOBAL_RATE / num_shards
+    )
+    try:
+        await on_startup(dispatcher, (shard, num_shards))
+        await consume_updates(dispatcher, queue)
+    finally:
+        await on_shutdown(dispatcher)
+        await bot.close()
+
+
+async def route_updates(queues):
+    try:
+        await ingest_updates(bot, queues)
+    finally:
+        await bot.close()
+
+
+def run_worker(queue, shard, num_shards):
+    """Entry point of the worker processes of `start_sharded`"""
+    # Workers are stopped by the ingest process, once it stops routing updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_database()
+    asyncio.run(start_worker(queue, shard, num_shards))
+
+
+def start_sharded(num_workers=None):
+    """Handle updates on `num_workers` processes. This process polls the updates and
+    routes them by chat id, so each worker owns the wild Pokemon and caches of its
+    chats. All of them share the same database.
+    """
+    num_workers = num_workers or os.cpu_count()
+    # Workers are spawned so they don't inherit this process' database connection
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(num_workers)]
+    workers = [
+        context.Process(
+            target=run_worker, args=(queue, shard, num_workers), name=f"worker-{shard}"
+        )
+        for shard, queue in enumerate(queues)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Stop cleanly on SIGTERM too, as sent by docker stop
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.info(f"Routing updates to {num_workers} workers...")
+    try:
+        asyncio.run(route_updates(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+
+def start_webhook():
+    """Serve updates from a webhook instead of polling for them. Text answers returned
+    by the handlers are sent back inside the webhook responses.
+    """
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL must be set to start on webhook mode")
+    webhook_path = WEBHOOK_PATH.rstrip("/")
+    if WEBHOOK_SECRET:
+        webhook_path += f"/{WEBHOOK_SECRET}"
+
+    async def on_webhook_startup(dispatcher: Dispatcher):
+        await on_startup(dispatcher)
+        await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{webhook_path}")
+        logger.info(f"Waiting for updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}...")
+
+    async def on_webhook_shutdown(dispatcher: Dispatcher):
+        # Clear the webhook so that the bot can be started again with polling
+        await bot.delete_webhook()
+        await on_shutdown(dispatcher)
+
+    executor.start_webhook(
+        dispatcher,
+        webhook_path,
+        on_startup=on_webhook_startup,
+        on_shutdown=on_webhook_shutdown,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+    )
+
+
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Oakoakbot's command line.")
     parser.add_argument(
         "action",
         choices=[
             "start",
+            "start-webhook",
+            "start-sharded",
             "init-images",
             "init-db",
             "validate-data",
@@ -321,20 +737,100 @@ if __name__ == "__main__":
         ],
         type=str,
     )
+    parser.add_argument(
+        "--groups",
+        type=positive_int,
+        default=100,
+        help="Groups used by check-performance and populate_database.",
+    )
+    parser.add_argument(
+        "--users",
+        type=positive_int,
+        default=1000,
+        help="Users used by check-performance.",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=1000, help="Calls per measured operation."
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="File to write the check-performance or validate-data JSON report to.",
+    )
+    parser.add_argument(
+        "--teams",
+        type=positive_int,
+        default=10000,
+        help="Teams used by populate_database.",
+    )
+    parser.add_argument(
+        "--catches",
+        type=int,
+        default=1000000,
+        help="Caught Pokemon inserted by populate_database.",
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Relax SQLite durability PRAGMAs while running populate_database.",
+    )
+    parser.add_argument("--seed", type=int, help="Random seed for populate_database.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Worker processes used by init-images and start-sharded.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Make init-images render every image and init-db reload every CSV, "
+        "even if they're up to date.",
+    )
     args = parser.parse_args()
+    if args.action.startswith("start") and "BOT_TOKEN" not in os.environ:
+        parser.error("BOT_TOKEN must be set to start the bot.")
 
+    # The benchmark creates and initializes its own temporary database
+    if args.action != "check-performance":
+        init_database()
     if args.action == "start":
         asyncio.run(start())
+    elif args.action == "start-webhook":
+        start_webhook()
+    elif args.action == "start-sharded":
+        start_sharded(args.workers)
     elif args.action == "init-db":
         query_t0 = time.time()
-        Pokemon.init_table_from_csv("data/pokemon_data/pokemon.csv")
-        PokemonNatures.init_table_from_csv("data/pokemon_data/natures.csv")
+        Pokemon.init_table_from_csv("data/pokemon_data/pokemon.csv", args.force)
+        PokemonNatures.init_table_from_csv("data/pokemon_data/natures.csv", args.force)
+        load_spawn_table()
         logger.info(f"DB initialization finished in {time.time() - query_t0:02}s.")
     elif args.action == "validate-data":
-        from scripts.data_validator import validate_data
+        from scripts.data_validator import print_report, validate_data
 
-        validate_data()
+        report = validate_data()
+        print_report(report, args.output)
+        if not report["valid"]:
+            sys.exit(1)
     elif args.action == "init-images":
         from scripts.image_preprocess import preprocess_images
 
-        preprocess_images()
+        preprocess_images(workers=args.workers, force=args.force)
+    elif args.action == "check-performance":
+        from scripts.benchmark import check_performance
+
+        check_performance(
+            args.groups,
+            args.users,
+            args.iterations,
+            args.output,
+            names_are_equivalent=pokemon_names_are_equivalent,
+            handlers={
+                "message_handler": message_handler,
+                "catch_handler": catch_handler,
+            },
+        )
+    elif args.action == "populate_database":
+        from scripts.populate_database import populate_database
+
+        populate_database(args.groups, args.teams, args.catches, args.fast, args.seed)
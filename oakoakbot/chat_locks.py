@@ -0,0 +1,30 @@
+import asyncio
+import contextlib
+
+
+class ChatLocks:
+    """One asyncio lock per chat, created on first use and dropped as soon as nobody
+    holds or waits for it.
+
+    Code holding a chat's lock runs strictly in order with any other code locking the
+    same chat, while different chats never wait on each other.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._users = {}
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, chat_id):
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._users[chat_id] = self._users.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[chat_id] -= 1
+            if not self._users[chat_id]:
+                del self._users[chat_id]
+                del self._locks[chat_id]
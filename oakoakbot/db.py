@@ -1,11 +1,17 @@
 import csv
 import datetime
+import hashlib
 import os
 import random
+import sqlite3
 import time
 
 from peewee import (
+    chunked,
+    sort_models,
     fn,
+    SQL,
+    IntegrityError,
     SqliteDatabase,
     Model,
     IntegerField,
@@ -16,22 +22,77 @@ from peewee import (
     ForeignKeyField,
 )
 
-from oakoakbot.images import load_pokemon_images
+from oakoakbot.executor import DatabaseExecutor
+from oakoakbot.images import get_sprite_names
 from oakoakbot.logger import get_logger
+from oakoakbot.metrics import count_cache, db_query_seconds
+from oakoakbot.name_index import NameIndex
+from oakoakbot.spawn_table import SpawnTable
+from oakoakbot.write_queue import WriteBehindQueue
 
 DEFAULT_SPAWN_RATE = 1 / 133
 NUM_GENERATIONS = 8
 
 DB_FILE = os.environ.get("DATABASE_PATH", "db/oak_db.sqlite3")
+DB_READERS = int(os.environ.get("DATABASE_READERS", 2))
+WRITE_FLUSH_INTERVAL_MS = int(os.environ.get("WRITE_FLUSH_INTERVAL_MS", 50))
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 100))
+SQLITE_MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32) else 999
+
+# SQLite PRAGMAs applied to every new connection. The "performance" profile trades
+# durability of the last few commits on power loss for far fewer fsyncs.
+DB_PROFILES = {
+    "default": {},
+    "performance": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -32 * 1024,  # 32MB
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "memory",
+        "busy_timeout": 5000,
+    },
+}
+DB_PROFILE = os.environ.get("DATABASE_PROFILE", "performance")
+DB_PRAGMAS = {
+    **DB_PROFILES[DB_PROFILE],
+    **dict(
+        pragma.split("=", 1)
+        for pragma in os.environ.get("DATABASE_PRAGMAS", "").split(",")
+        if pragma
+    ),
+}
 
 logger = get_logger()
 
 if not os.path.isdir(os.path.dirname(DB_FILE)):
     os.makedirs(os.path.dirname(DB_FILE))
-db = SqliteDatabase(DB_FILE)
+db = SqliteDatabase(DB_FILE, pragmas=DB_PRAGMAS)
+spawn_table = SpawnTable()
+name_index = NameIndex()
+groups_config = {}
+teams_cache = {}
+db_executor = DatabaseExecutor(db, readers=DB_READERS)
+write_queue = WriteBehindQueue(
+    db,
+    db_executor,
+    flush_interval=WRITE_FLUSH_INTERVAL_MS / 1000,
+    max_batch=WRITE_BATCH_SIZE,
+    on_rollback=teams_cache.clear,
+)
 
 
 class WildEncounter:
+    __slots__ = (
+        "pokemon",
+        "release_time",
+        "nature",
+        "shiny",
+        "ability",
+        "gender",
+        "colour_sprite",
+        "silhouette_sprite",
+    )
+
     def __init__(self, pokemon, shiny=False):
         self.pokemon = pokemon
         self.release_time = time.time()
@@ -54,7 +115,23 @@ class WildEncounter:
         elif self.pokemon.gender == "uk":
             self.gender = "unknown"
 
-        self.colour_image, self.silhouette_image = load_pokemon_images(
+        self._set_sprite_names()
+
+    @staticmethod
+    def restore(pokemon, shiny, nature, ability, gender, release_time):
+        """Rebuild an encounter from the state saved in `ActiveEncounters`"""
+        wild_encounter = WildEncounter.__new__(WildEncounter)
+        wild_encounter.pokemon = pokemon
+        wild_encounter.shiny = shiny
+        wild_encounter.nature = nature
+        wild_encounter.ability = ability
+        wild_encounter.gender = gender
+        wild_encounter.release_time = release_time
+        wild_encounter._set_sprite_names()
+        return wild_encounter
+
+    def _set_sprite_names(self):
+        self.colour_sprite, self.silhouette_sprite = get_sprite_names(
             self.pokemon.number,
             self.pokemon.form,
             self.pokemon.region,
@@ -64,26 +141,158 @@ class WildEncounter:
         )
 
 
+class GroupConfig:
+    """Parsed configuration of a group, as kept in the `groups_config` cache"""
+
+    def __init__(self, pokemon_rate, generations):
+        self.pokemon_rate = pokemon_rate
+        self.generations = generations
+
+    @staticmethod
+    def from_row(row):
+        generations = [int(gen) for gen in row.generations.split(",")]
+        return GroupConfig(row.pokemon_rate, generations)
+
+
+class TeamEntry:
+    """Id and next free `team_pokemon_id` of a team, as kept in the `teams_cache`"""
+
+    def __init__(self, team_id, next_slot):
+        self.team_id = team_id
+        self.next_slot = next_slot
+
+
 class CustomModel(Model):
     class Meta:
         database = db
 
 
+class DataLoads(CustomModel):
+    """Hash of the last CSV loaded into each table, to skip loads with no changes"""
+
+    table_name = CharField(primary_key=True)
+    csv_hash = CharField()
+    loaded_at = DateTimeField(default=datetime.datetime.now)
+
+
+# Converters from CSV strings to the Python type of each kind of field
+CSV_CONVERTERS = {
+    "AUTO": int,
+    "INT": int,
+    "BIGINT": int,
+    "FLOAT": float,
+    "DOUBLE": float,
+    "BOOL": lambda value: bool(int(value)),
+}
+
+
+def get_csv_converter(field):
+    convert = CSV_CONVERTERS.get(field.field_type, str)
+    if field.null:
+        return lambda value: None if value == "" else convert(value)
+    return convert
+
+
+def load_table_from_csv(model, csv_filename, force=False):
+    """Load a CSV into the table of `model`, applying only its differences with the
+    rows already there.
+
+    Rows are streamed from the CSV and coerced to the types of the model fields.
+    CSVs without an id column have their rows numbered from 1. All the changes run
+    inside a single transaction, so readers see either the previous or the new
+    table, never an empty or half-loaded one, and the ids referenced by other tables
+    are kept. Loads of a CSV that hasn't changed since the last one are skipped,
+    unless `force` is set.
+    """
+    t0 = time.time()
+    csv_hash = hashlib.blake2b(digest_size=16)
+    with open(csv_filename, "rb") as csv_file:
+        while block := csv_file.read(1024 * 1024):
+            csv_hash.update(block)
+    csv_hash = csv_hash.hexdigest()
+
+    table_name = model._meta.table_name
+    last_load = DataLoads.get_or_none(DataLoads.table_name == table_name)
+    if (
+        not force
+        and last_load is not None
+        and last_load.csv_hash == csv_hash
+        and model.select().exists()
+    ):
+        logger.info(f"{csv_filename} hasn't changed since its last load.")
+        return
+
+    primary_key = model._meta.primary_key
+    with open(csv_filename, "r", newline="") as csv_file, db.atomic():
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        unknown_columns = set(header) - model._meta.fields.keys()
+        if unknown_columns:
+            raise ValueError(
+                f"{csv_filename} has columns that aren't fields of {model.__name__}: "
+                f"{', '.join(sorted(unknown_columns))}"
+            )
+        fields = [model._meta.fields[column] for column in header]
+        converters = [get_csv_converter(field) for field in fields]
+        numbered = primary_key not in fields
+        if numbered:
+            fields.insert(0, primary_key)
+        id_index = fields.index(primary_key)
+        batch_size = max(1, SQLITE_MAX_VARIABLES // len(fields))
+
+        current = {row[id_index]: row for row in model.select(*fields).tuples()}
+        seen = set()
+        new_rows = []
+        inserted = updated = 0
+        for row_number, values in enumerate(reader, 1):
+            row = tuple(convert(value) for convert, value in zip(converters, values))
+            if numbered:
+                row = (row_number, *row)
+            row_id = row[id_index]
+            seen.add(row_id)
+
+            previous = current.get(row_id)
+            if previous is None:
+                new_rows.append(row)
+                if len(new_rows) == batch_size:
+                    model.insert_many(new_rows, fields=fields).execute()
+                    inserted += len(new_rows)
+                    new_rows = []
+            elif previous != row:
+                model.update(dict(zip(fields, row))).where(
+                    primary_key == row_id
+                ).execute()
+                updated += 1
+        if new_rows:
+            model.insert_many(new_rows, fields=fields).execute()
+            inserted += len(new_rows)
+
+        removed_ids = current.keys() - seen
+        for ids in chunked(removed_ids, SQLITE_MAX_VARIABLES):
+            model.delete().where(primary_key.in_(ids)).execute()
+
+        DataLoads.replace(table_name=table_name, csv_hash=csv_hash).execute()
+
+    logger.info(
+        f"Loaded {csv_filename} into {table_name} in {time.time() - t0:.2f}s: "
+        f"{inserted} inserted, {updated} updated and {len(removed_ids)} deleted rows."
+    )
+
+
 class PokemonNatures(CustomModel):
     name = CharField()
     increases = CharField()
     decreases = CharField()
 
     @staticmethod
-    def init_table_from_csv(csv_filename):
-        PokemonNatures.delete().execute()
-        with open(csv_filename, "r") as csv_file:
-            rows = csv.DictReader(csv_file)
-            PokemonNatures.insert_many(rows).execute()
+    def init_table_from_csv(csv_filename, force=False):
+        load_table_from_csv(PokemonNatures, csv_filename, force)
 
     @staticmethod
     def get_random_nature():
-        return PokemonNatures.select().order_by(fn.Random()).limit(1).execute()[0].id
+        if not spawn_table.loaded:
+            load_spawn_table()
+        return spawn_table.draw_nature()
 
 
 class Pokemon(CustomModel):
@@ -112,52 +321,71 @@ class Pokemon(CustomModel):
     rarity_tier = CharField()
     gender = CharField()
 
+    class Meta:
+        indexes = ((("generation", "rarity_tier", "enabled", "mega"), False),)
+
     @staticmethod
-    def init_table_from_csv(csv_filename):
-        Pokemon.delete().execute()
-        with open(csv_filename, "r") as csv_file:
-            pokemon = list(csv.DictReader(csv_file))
-            for p in pokemon:
-                p["legendary"] = bool(int(p["legendary"]))
-                p["mega"] = bool(int(p["mega"]))
-                p["enabled"] = bool(int(p["enabled"]))
-            Pokemon.insert_many(pokemon).execute()
+    def init_table_from_csv(csv_filename, force=False):
+        load_table_from_csv(Pokemon, csv_filename, force)
 
     @staticmethod
     def get_random_encounter(
         generations: list, rarity_tier: str, shiny=False
     ) -> WildEncounter:
-        pokemon = (
-            Pokemon.select()
-            .where(
-                (
-                    Pokemon.number
-                    == Pokemon.select(Pokemon.number)
-                    .where(
-                        Pokemon.generation.in_(generations)
-                        & (Pokemon.mega == 0)
-                        & (Pokemon.enabled == 1)
-                        & (Pokemon.rarity_tier == rarity_tier)
-                    )
-                    .group_by(Pokemon.number)
-                    .order_by(fn.Random())
-                    .limit(1)
-                )
-                & (Pokemon.mega == 0)
-                & (Pokemon.enabled == 1)
-                & (Pokemon.rarity_tier == rarity_tier)
-            )
-            .order_by(fn.Random())
-            .limit(1)
-            .execute()
-        )[0]
+        if not spawn_table.loaded:
+            load_spawn_table()
+        pokemon = spawn_table.draw_pokemon(generations, rarity_tier)
 
         return WildEncounter(pokemon, shiny)
 
 
+@db_query_seconds.time
+def load_spawn_table():
+    """Load all spawnable Pokemon and natures into the in-memory spawn table and the
+    name index used to check /catch guesses
+    """
+    pokemon = Pokemon.select().where((Pokemon.mega == 0) & (Pokemon.enabled == 1))
+    natures = PokemonNatures.select(PokemonNatures.id).tuples()
+    spawn_table.load(pokemon, [nature_id for nature_id, in natures])
+    name_index.load(pokemon)
+    logger.info(f"Spawn table loaded with {len(pokemon)} Pokemon.")
+
+
 class Teams(CustomModel):
-    user_id = CharField()
-    group_id = CharField()
+    user_id = IntegerField()
+    group_id = IntegerField()
+
+    class Meta:
+        indexes = ((("user_id", "group_id"), True),)
+
+    @staticmethod
+    @db_query_seconds.time
+    def get_team(user_id, group_id):
+        """Get the cached team of a user on a group, creating the team if needed.
+        Must only be called from the database writer thread.
+        """
+        team = teams_cache.get((user_id, group_id))
+        count_cache("teams", team is not None)
+        if team is not None:
+            return team
+
+        team_row = Teams.get_or_none(
+            (Teams.user_id == user_id) & (Teams.group_id == group_id)
+        )
+        if team_row is None:
+            logger.info(f"User {user_id} started a brand new team.")
+            team_id = Teams.insert(user_id=user_id, group_id=group_id).execute()
+            team = TeamEntry(team_id, 0)
+        else:
+            last_slot = (
+                CaughtPokemon.select(fn.MAX(CaughtPokemon.team_pokemon_id))
+                .where(CaughtPokemon.team == team_row.id)
+                .scalar()
+            )
+            team = TeamEntry(team_row.id, 0 if last_slot is None else last_slot + 1)
+
+        teams_cache[(user_id, group_id)] = team
+        return team
 
 
 class CaughtPokemon(CustomModel):
@@ -177,40 +405,47 @@ class CaughtPokemon(CustomModel):
     special_defense_iv = IntegerField()
     speed_iv = IntegerField()
 
+    class Meta:
+        indexes = ((("team", "team_pokemon_id"), True),)
+
+    @staticmethod
+    @db_query_seconds.time
+    def catch_pokemon_sync(wild_encounter: WildEncounter, user_id: int, group_id: int):
+        team = Teams.get_team(user_id, group_id)
+        try:
+            CaughtPokemon.insert(
+                team=team.team_id,
+                team_pokemon_id=team.next_slot,
+                pokemon=wild_encounter.pokemon.id,
+                catch_date=datetime.datetime.now(),
+                shiny=wild_encounter.shiny,
+                gender=wild_encounter.gender,
+                ability=wild_encounter.ability,
+                nature=wild_encounter.nature,
+                hp_iv=random.randint(0, 31),
+                attack_iv=random.randint(0, 31),
+                defense_iv=random.randint(0, 31),
+                special_attack_iv=random.randint(0, 31),
+                special_defense_iv=random.randint(0, 31),
+                speed_iv=random.randint(0, 31),
+            ).execute()
+        except Exception:
+            # The team might have been created inside the rolled back savepoint
+            teams_cache.pop((user_id, group_id), None)
+            raise
+        team.next_slot += 1
+        # Forgotten in the same savepoint, so a restored encounter is never caught twice
+        ActiveEncounters.forget_encounter(group_id)
+
     @staticmethod
     async def catch_pokemon(wild_encounter: WildEncounter, user_id: int, group_id: int):
-        team_id = (
-            Teams.select(Teams.id)
-            .where((Teams.user_id == user_id) & (Teams.group_id == group_id))
-            .execute()
+        await write_queue.submit(
+            CaughtPokemon.catch_pokemon_sync, wild_encounter, user_id, group_id
         )
-        if not len(team_id):
-            logger.info(f"User {user_id} started a brand new team.")
-            team_id = Teams.insert(user_id=user_id, group_id=group_id).execute()
-        else:
-            team_id = team_id[0].id
-
-        CaughtPokemon.insert(
-            team=team_id,
-            team_pokemon_id=CaughtPokemon.select()
-            .where(CaughtPokemon.team_id == team_id)
-            .count(),
-            pokemon=wild_encounter.pokemon.id,
-            catch_date=datetime.datetime.now(),
-            shiny=wild_encounter.shiny,
-            gender=wild_encounter.gender,
-            ability=wild_encounter.ability,
-            nature=wild_encounter.nature,
-            hp_iv=random.randint(0, 31),
-            attack_iv=random.randint(0, 31),
-            defense_iv=random.randint(0, 31),
-            special_attack_iv=random.randint(0, 31),
-            special_defense_iv=random.randint(0, 31),
-            speed_iv=random.randint(0, 31),
-        ).execute()
 
     @staticmethod
-    async def get_caught_pokemon(user_id, group_id):
+    @db_query_seconds.time
+    def get_caught_pokemon_sync(user_id, group_id):
         return list(
             CaughtPokemon.select()
             .join(Pokemon, on=(CaughtPokemon.pokemon == Pokemon.id))
@@ -224,6 +459,71 @@ class CaughtPokemon(CustomModel):
             .execute()
         )
 
+    @staticmethod
+    async def get_caught_pokemon(user_id, group_id):
+        return await db_executor.read(
+            CaughtPokemon.get_caught_pokemon_sync, user_id, group_id
+        )
+
+    @staticmethod
+    @db_query_seconds.time
+    def get_team_page_sync(user_id, group_id, slot, page_size, backwards=False):
+        """Get a page of (team_pokemon_id, name) pairs of a team using keyset
+        pagination over the (team, team_pokemon_id) index. The page starts at `slot`,
+        or ends right before it if `backwards` is set.
+
+        Returns the page and whether there are any Pokemon before and after it.
+        """
+        if (team := teams_cache.get((user_id, group_id))) is not None:
+            team_id = team.team_id
+        else:
+            team_id = (
+                Teams.select(Teams.id)
+                .where((Teams.user_id == user_id) & (Teams.group_id == group_id))
+                .scalar()
+            )
+        if team_id is None:
+            return [], False, False
+
+        team_pokemon = CaughtPokemon.select().where(CaughtPokemon.team == team_id)
+        query = (
+            CaughtPokemon.select(CaughtPokemon.team_pokemon_id, Pokemon.name)
+            .join(Pokemon, on=(CaughtPokemon.pokemon == Pokemon.id))
+            .where(CaughtPokemon.team == team_id)
+            .limit(page_size)
+        )
+        if backwards:
+            query = query.where(CaughtPokemon.team_pokemon_id < slot).order_by(
+                CaughtPokemon.team_pokemon_id.desc()
+            )
+            page = list(reversed(query.tuples()))
+        else:
+            query = query.where(CaughtPokemon.team_pokemon_id >= slot).order_by(
+                CaughtPokemon.team_pokemon_id
+            )
+            page = list(query.tuples())
+        if not page:
+            return [], False, False
+
+        has_previous = team_pokemon.where(
+            CaughtPokemon.team_pokemon_id < page[0][0]
+        ).exists()
+        has_next = team_pokemon.where(
+            CaughtPokemon.team_pokemon_id > page[-1][0]
+        ).exists()
+        return page, has_previous, has_next
+
+    @staticmethod
+    async def get_team_page(user_id, group_id, slot, page_size, backwards=False):
+        return await db_executor.read(
+            CaughtPokemon.get_team_page_sync,
+            user_id,
+            group_id,
+            slot,
+            page_size,
+            backwards,
+        )
+
 
 class GroupsConfiguration(CustomModel):
     group_id = IntegerField(unique=True)
@@ -233,32 +533,83 @@ class GroupsConfiguration(CustomModel):
     )
 
     @staticmethod
+    @db_query_seconds.time
+    def load_groups():
+        """Fill the configuration cache with every registered group"""
+        groups_config.clear()
+        for group in GroupsConfiguration.select():
+            groups_config[group.group_id] = GroupConfig.from_row(group)
+        return list(groups_config)
+
+    @staticmethod
+    def get_config(group_id):
+        config = groups_config.get(group_id)
+        count_cache("groups_config", config is not None)
+        if config is None:
+            config = GroupsConfiguration.load_group(group_id)
+        return config
+
+    @staticmethod
+    @db_query_seconds.time
+    def load_group(group_id):
+        """Read the configuration of a group into the cache, if it's registered"""
+        group = GroupsConfiguration.get_or_none(
+            GroupsConfiguration.group_id == group_id
+        )
+        if group is None:
+            return None
+        config = groups_config[group_id] = GroupConfig.from_row(group)
+        return config
+
+    @staticmethod
+    async def get_config_async(group_id):
+        if (config := groups_config.get(group_id)) is not None:
+            count_cache("groups_config", True)
+            return config
+        return await db_executor.read(GroupsConfiguration.get_config, group_id)
+
+    @staticmethod
+    @db_query_seconds.time
     def add_group(group_id):
-        GroupsConfiguration.insert(group_id=group_id).execute()
+        GroupsConfiguration.insert(group_id=group_id).on_conflict_ignore().execute()
+        groups_config[group_id] = GroupConfig.from_row(
+            GroupsConfiguration(group_id=group_id)
+        )
+
+    @staticmethod
+    async def add_group_async(group_id):
+        await write_queue.submit(GroupsConfiguration.add_group, group_id)
 
     @staticmethod
+    @db_query_seconds.time
     def get_groups():
         groups = GroupsConfiguration.select(GroupsConfiguration.group_id).execute()
         return [group.group_id for group in groups]
 
     @staticmethod
+    @db_query_seconds.time
     def set_pokemon_rate(group_id, pokemon_rate):
         updated_rows = (
             GroupsConfiguration.update(pokemon_rate=pokemon_rate)
             .where(GroupsConfiguration.group_id == group_id)
             .execute()
         )
+        if (config := groups_config.get(group_id)) is not None:
+            config.pokemon_rate = pokemon_rate
         return updated_rows == 1
 
+    @staticmethod
+    async def set_pokemon_rate_async(group_id, pokemon_rate):
+        return await db_executor.write(
+            GroupsConfiguration.set_pokemon_rate, group_id, pokemon_rate
+        )
+
     @staticmethod
     def get_pokemon_rate(group_id):
-        return (
-            GroupsConfiguration.select(GroupsConfiguration.pokemon_rate)
-            .where(GroupsConfiguration.group_id == group_id)
-            .execute()
-        )[0].pokemon_rate
+        return GroupsConfiguration.get_config(group_id).pokemon_rate
 
     @staticmethod
+    @db_query_seconds.time
     def set_generations(group_id, generations):
         generations_serialized = ",".join(str(gen) for gen in generations)
         updated_rows = (
@@ -266,17 +617,143 @@ class GroupsConfiguration(CustomModel):
             .where(GroupsConfiguration.group_id == group_id)
             .execute()
         )
+        if (config := groups_config.get(group_id)) is not None:
+            config.generations = list(generations)
         return updated_rows == 1
 
+    @staticmethod
+    async def set_generations_async(group_id, generations):
+        return await db_executor.write(
+            GroupsConfiguration.set_generations, group_id, generations
+        )
+
     @staticmethod
     def get_generations(group_id):
-        generations = (
-            GroupsConfiguration.select(GroupsConfiguration.generations)
-            .where(GroupsConfiguration.group_id == group_id)
-            .execute()
-        )[0].generations
-        return [int(gen) for gen in generations.split(",")]
+        return GroupsConfiguration.get_config(group_id).generations
+
+
+class ActiveEncounters(CustomModel):
+    """Wild Pokemon currently out on each group, so they survive restarts. Only the
+    state needed to rebuild the encounter is saved, never its images.
+    """
+
+    group_id = IntegerField(primary_key=True)
+    pokemon = ForeignKeyField(Pokemon)
+    shiny = BooleanField()
+    nature = ForeignKeyField(PokemonNatures)
+    ability = CharField()
+    gender = CharField()
+    release_time = FloatField()
+
+    @staticmethod
+    @db_query_seconds.time
+    def save_encounter(group_id, wild_encounter: WildEncounter):
+        ActiveEncounters.replace(
+            group_id=group_id,
+            pokemon=wild_encounter.pokemon.id,
+            shiny=wild_encounter.shiny,
+            nature=wild_encounter.nature,
+            ability=wild_encounter.ability,
+            gender=wild_encounter.gender,
+            release_time=wild_encounter.release_time,
+        ).execute()
+
+    @staticmethod
+    async def save_encounter_async(group_id, wild_encounter: WildEncounter):
+        await write_queue.submit(
+            ActiveEncounters.save_encounter, group_id, wild_encounter
+        )
+
+    @staticmethod
+    @db_query_seconds.time
+    def forget_encounter(group_id):
+        ActiveEncounters.delete().where(ActiveEncounters.group_id == group_id).execute()
+
+    @staticmethod
+    async def forget_encounter_async(group_id):
+        await write_queue.submit(ActiveEncounters.forget_encounter, group_id)
+
+    @staticmethod
+    @db_query_seconds.time
+    def load_encounters(timeout):
+        """Rebuild the encounters saved less than `timeout` seconds ago, keyed by group
+        id, and forget the ones that already fled.
+        """
+        expiry = time.time() - timeout
+        ActiveEncounters.delete().where(
+            ActiveEncounters.release_time <= expiry
+        ).execute()
+
+        encounters = {}
+        query = ActiveEncounters.select(ActiveEncounters, Pokemon).join(Pokemon)
+        for row in query:
+            encounters[row.group_id] = WildEncounter.restore(
+                row.pokemon,
+                row.shiny,
+                row.nature_id,
+                row.ability,
+                row.gender,
+                row.release_time,
+            )
+        return encounters
+
+
+MODELS = [
+    Pokemon,
+    PokemonNatures,
+    Teams,
+    GroupsConfiguration,
+    CaughtPokemon,
+    DataLoads,
+    ActiveEncounters,
+]
+
+
+def migrate_database():
+    """Bring databases created by older versions up to date with the models"""
+    # Teams ids used to be stored on VARCHAR columns
+    columns = {column.name: column.data_type for column in db.get_columns("teams")}
+    if columns["user_id"].upper() != "INTEGER":
+        logger.info("Migrating teams ids to INTEGER columns.")
+        with db.atomic():
+            db.execute_sql(
+                'CREATE TABLE "teams_new" ("id" INTEGER NOT NULL PRIMARY KEY, '
+                '"user_id" INTEGER NOT NULL, "group_id" INTEGER NOT NULL)'
+            )
+            db.execute_sql(
+                'INSERT INTO "teams_new" ("id", "user_id", "group_id") '
+                'SELECT "id", CAST("user_id" AS INTEGER), CAST("group_id" AS INTEGER) '
+                'FROM "teams"'
+            )
+            db.execute_sql('DROP TABLE "teams"')
+            db.execute_sql('ALTER TABLE "teams_new" RENAME TO "teams"')
+
+    # Create the indexes missing on databases created before they were declared
+    for model in MODELS:
+        for index in model._meta.fields_to_index():
+            try:
+                db.execute(model._schema._create_index(index, safe=True))
+            except IntegrityError:
+                fields = index._expressions
+                duplicates = (
+                    model.select(*fields)
+                    .group_by(*fields)
+                    .having(fn.COUNT(SQL("*")) > 1)
+                    .count()
+                )
+                columns = ", ".join(field.column_name for field in fields)
+                logger.error(
+                    f"Couldn't create unique index on {model._meta.table_name}"
+                    f"({columns}), found {duplicates} duplicated keys. Remove the "
+                    f"duplicates and restart to create it."
+                )
 
 
-db.connect()
-db.create_tables([Pokemon, PokemonNatures, Teams, GroupsConfiguration, CaughtPokemon])
+def init_database():
+    """Connect to the database, creating any missing table and migrating old ones"""
+    db.connect(reuse_if_open=True)
+    # Indexes are only created once the old tables have been migrated, so that a new
+    # unique index failing on an old table can be reported instead of aborting
+    for model in sort_models(MODELS):
+        model._schema.create_table(safe=True)
+    migrate_database()
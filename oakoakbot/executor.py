@@ -0,0 +1,52 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DatabaseExecutor:
+    """Run blocking peewee calls away from the asyncio event loop.
+
+    Writes are serialized on a single dedicated thread, which avoids SQLite lock
+    contention between writers. Reads are spread over a small pool of threads whose
+    connections are flagged as read-only. Peewee keeps one connection per thread, so
+    every worker thread keeps its own connection open for its whole lifetime.
+    """
+
+    def __init__(self, database, readers=2):
+        self.database = database
+        self._writer = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="db-writer",
+            initializer=self._connect,
+        )
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers,
+            thread_name_prefix="db-reader",
+            initializer=self._connect,
+            initargs=(True,),
+        )
+
+    def _connect(self, read_only=False):
+        self.database.connect(reuse_if_open=True)
+        if read_only:
+            self.database.execute_sql("PRAGMA query_only = 1")
+
+    @staticmethod
+    async def _run(executor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # Run in a copy of the caller's context, so its update trace sees the query
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            executor, functools.partial(context.run, func, *args, **kwargs)
+        )
+
+    async def read(self, func, *args, **kwargs):
+        return await self._run(self._readers, func, *args, **kwargs)
+
+    async def write(self, func, *args, **kwargs):
+        return await self._run(self._writer, func, *args, **kwargs)
+
+    def shutdown(self):
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
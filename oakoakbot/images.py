@@ -1,22 +1,197 @@
+import asyncio
+import fcntl
+import json
 import os
+import tempfile
+from collections import OrderedDict
+
+from oakoakbot.logger import get_logger
+from oakoakbot.metrics import count_cache
+from oakoakbot.sprite_atlas import SpriteAtlas, parse_sprite_name
+
+logger = get_logger()
 
 SPRITES_FOLDER = os.environ.get("IMAGES_PATH", "data/images")
+SPRITE_CACHE_SIZE = int(os.environ.get("SPRITE_CACHE_SIZE", 64 * 1024 * 1024))
+FILE_IDS_PATH = os.environ.get(
+    "SPRITE_FILE_IDS_PATH",
+    os.path.join(
+        os.path.dirname(os.environ.get("DATABASE_PATH", "db/oak_db.sqlite3")),
+        "sprite_file_ids.json",
+    ),
+)
+SPRITE_ATLAS_PATH = os.environ.get(
+    "SPRITE_ATLAS_PATH", os.path.join(SPRITES_FOLDER, "sprites.atlas")
+)
 
 
-def load_pokemon_images(number, form, region, is_shiny, is_mega, gender) -> tuple:
+class SpriteCache:
+    """LRU cache of sprite bytes bounded to `max_bytes`, together with a persistent
+    map from sprite name to the Telegram file_id it got when it was first uploaded.
+
+    Sprites found in `atlas` are served straight from it as memoryviews and never
+    take space in the cache; loose files are only read for sprites missing from it.
+    """
+
+    def __init__(self, folder, max_bytes, file_ids_path, atlas=None):
+        self.folder = folder
+        self.atlas = atlas
+        self.max_bytes = max_bytes
+        self.file_ids_path = file_ids_path
+        self.size = 0
+        self._sprites = OrderedDict()
+        self._prefetches = {}
+
+        self._file_ids = self._load_file_ids()
+        self._unsaved_file_ids = {}
+        self._saving = None
+
+    def get(self, name):
+        if self.atlas is not None:
+            sprite = self.atlas.get(parse_sprite_name(name))
+            if sprite is not None:
+                count_cache("sprites", True)
+                return sprite
+
+        sprite = self._sprites.get(name)
+        count_cache("sprites", sprite is not None)
+        if sprite is not None:
+            self._sprites.move_to_end(name)
+            return sprite
+        return self._store(name, self._read(name))
+
+    def prefetch(self, name):
+        """Load a sprite into the cache in the background, unless it's already cached
+        or it can be sent by file_id, in which case its bytes won't be needed.
+        """
+        if name in self._sprites or name in self._file_ids or name in self._prefetches:
+            return
+        if self.atlas is not None and (key := parse_sprite_name(name)) in self.atlas:
+            self.atlas.prefetch(key)
+            return
+        task = asyncio.ensure_future(self._prefetch(name))
+        self._prefetches[name] = task
+        task.add_done_callback(lambda _: self._prefetches.pop(name, None))
+
+    async def _prefetch(self, name):
+        loop = asyncio.get_running_loop()
+        sprite = await loop.run_in_executor(None, self._read, name)
+        if name not in self._sprites:
+            self._store(name, sprite)
+
+    def _read(self, name):
+        with open(os.path.join(self.folder, name), "rb") as image:
+            return image.read()
+
+    def _store(self, name, sprite):
+        self._sprites[name] = sprite
+        self.size += len(sprite)
+        while self.size > self.max_bytes and len(self._sprites) > 1:
+            _, evicted = self._sprites.popitem(last=False)
+            self.size -= len(evicted)
+        return sprite
+
+    def get_file_id(self, name):
+        file_id = self._file_ids.get(name)
+        count_cache("file_ids", file_id is not None)
+        return file_id
+
+    def set_file_id(self, name, file_id):
+        self._file_ids[name] = file_id
+        self._queue_save(name, file_id)
+
+    def forget_file_id(self, name):
+        if self._file_ids.pop(name, None) is not None:
+            self._queue_save(name, None)
+
+    def _queue_save(self, name, file_id):
+        """Save a file_id change in the background. Changes made while a save is
+        running are saved together right after it.
+        """
+        self._unsaved_file_ids[name] = file_id
+        if self._saving is None:
+            self._saving = asyncio.ensure_future(self._save_unsaved_file_ids())
+
+    async def _save_unsaved_file_ids(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._unsaved_file_ids:
+                changes, self._unsaved_file_ids = self._unsaved_file_ids, {}
+                try:
+                    saved = await loop.run_in_executor(
+                        None, self._save_file_ids, changes
+                    )
+                except Exception as e:
+                    logger.warning(f"Couldn't save sprite file_ids: {e}")
+                    continue
+                # Pick up the file_ids saved by other workers
+                for name, file_id in saved.items():
+                    self._file_ids.setdefault(name, file_id)
+        finally:
+            self._saving = None
+
+    async def close(self):
+        """Wait for the pending file_id changes to be saved"""
+        if self._saving is not None:
+            await self._saving
+
+    def _load_file_ids(self):
+        if not os.path.isfile(self.file_ids_path):
+            return {}
+        with open(self.file_ids_path, "r") as file_ids:
+            return json.load(file_ids)
+
+    def _save_file_ids(self, changes):
+        """Apply `changes` to the saved file_ids, a None file_id removing its sprite,
+        and return all the saved file_ids. Blocking, run on an executor thread.
+
+        Sharded workers share the file, so it's updated under an exclusive lock and
+        the changes are merged with the file_ids saved by the other workers.
+        """
+        folder = os.path.dirname(self.file_ids_path) or "."
+        os.makedirs(folder, exist_ok=True)
+        with open(f"{self.file_ids_path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            file_ids = self._load_file_ids()
+            for name, file_id in changes.items():
+                if file_id is None:
+                    file_ids.pop(name, None)
+                else:
+                    file_ids[name] = file_id
+
+            fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as tmp_file:
+                    json.dump(file_ids, tmp_file)
+                os.replace(tmp_path, self.file_ids_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        return file_ids
+
+
+sprite_cache = SpriteCache(
+    SPRITES_FOLDER,
+    SPRITE_CACHE_SIZE,
+    FILE_IDS_PATH,
+    SpriteAtlas.open(SPRITE_ATLAS_PATH),
+)
+
+
+def get_sprite_names(number, form, region, is_shiny, is_mega, gender) -> tuple:
     shiny_flag = "s" if is_shiny else "n"
     mega_flag = "m" if is_mega else "n"
 
-    # Get colour image
     filename = f"{number:04}_{form:02}_{region}_{shiny_flag}_{mega_flag}_{gender}.jpg"
-    with open(os.path.join(SPRITES_FOLDER, "colour", filename), "rb") as image:
-        file = image.read()
-        colour_image = bytearray(file)
+    colour_name = os.path.join("colour", filename)
 
-    # Get silhouette image
     filename = f"{number:04}_{form:02}_{region}_{mega_flag}_{gender}.jpg"
-    with open(os.path.join(SPRITES_FOLDER, "silhouettes", filename), "rb") as image:
-        file = image.read()
-        silhouette_image = bytearray(file)
+    silhouette_name = os.path.join("silhouettes", filename)
+    return colour_name, silhouette_name
+
 
-    return colour_image, silhouette_image
+def load_pokemon_images(number, form, region, is_shiny, is_mega, gender) -> tuple:
+    colour_name, silhouette_name = get_sprite_names(
+        number, form, region, is_shiny, is_mega, gender
+    )
+    return sprite_cache.get(colour_name), sprite_cache.get(silhouette_name)
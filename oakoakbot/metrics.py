@@ -0,0 +1,184 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import threading
+import time
+
+from aiohttp import web
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow API calls
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+# Spans timed while handling the current update, only set when tracing updates
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def format_labels(names, values, extra=""):
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        # Counters without labels are exported even before their first increment
+        self._values = {} if labels else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}_total{format_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    """Histogram of durations in seconds. Observations made while an update is being
+    traced are also added to its trace.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket, plus one for +Inf], sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+        if (trace := current_trace.get()) is not None:
+            trace.append((labels[0] if labels else self.name, value))
+
+    def time(self, func, *labels):
+        """Decorate `func`, sync or async, to observe how long each call takes"""
+        labels = labels or (func.__qualname__,)
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - t0, *labels)
+
+        else:
+
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - t0, *labels)
+
+        return timed
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = format_labels(self.labels, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            labels = format_labels(self.labels, labels)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(registry, host, port):
+    """Serve the metrics of `registry` on http://host:port/metrics. Returns the
+    runner, to be cleaned up on shutdown.
+    """
+
+    async def metrics_handler(_):
+        return web.Response(text=registry.render(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    "oakoakbot_handler_seconds", "Time spent handling an update.", ("handler",)
+)
+db_query_seconds = registry.histogram(
+    "oakoakbot_db_query_seconds", "Time spent running a database query.", ("query",)
+)
+spawns = registry.counter("oakoakbot_spawns", "Wild Pokemon spawned.")
+catches = registry.counter("oakoakbot_catches", "Wild Pokemon caught.")
+flees = registry.counter("oakoakbot_flees", "Wild Pokemon that fled.")
+cache_requests = registry.counter(
+    "oakoakbot_cache_requests",
+    "Cache lookups by cache and result.",
+    ("cache", "result"),
+)
+
+
+def count_cache(cache, hit):
+    cache_requests.inc(cache, "hit" if hit else "miss")
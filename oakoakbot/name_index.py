@@ -0,0 +1,131 @@
+import string
+from collections import defaultdict
+
+REGIONS = ["alolan", "galarian"]
+GENDERS = {"m": "male", "f": "female"}
+TRANS_TABLE = str.maketrans("", "", string.punctuation + " ")
+
+
+def normalize_name(name):
+    """Lowercase a name and remove its spaces and punctuation"""
+    return name.lower().translate(TRANS_TABLE)
+
+
+def bounded_edit_distance(a, b, max_distance):
+    """Levenshtein distance between `a` and `b`, or `max_distance + 1` as soon as it's
+    known to be larger than `max_distance`.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char_a != char_b),
+                )
+            )
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+def get_deletions(word, max_deletions):
+    """Every string obtained by deleting up to `max_deletions` characters of `word`"""
+    deletions = {word}
+    frontier = {word}
+    for _ in range(max_deletions):
+        frontier = {w[:i] + w[i + 1 :] for w in frontier for i in range(len(w))}
+        deletions |= frontier
+    return deletions
+
+
+class NameIndex:
+    """Index from every accepted normalized spelling of a Pokemon name to the ids of
+    the Pokemon it refers to, so checking a /catch guess is one normalize and lookup.
+
+    Regional Pokemon can be named with or without their region as a prefix or suffix
+    ("alolan" or "alola"), and gendered ones with or without their gender ("m" or
+    "male").
+
+    Suggestions for wrong guesses use the deletion neighbourhoods of the names: two
+    strings within `max_distance` edits share a string obtained by deleting up to
+    `max_distance` characters from each, so only names sharing one with the guess are
+    compared with it.
+    """
+
+    def __init__(self, max_distance=2):
+        self.max_distance = max_distance
+        self._aliases = {}
+        self._names = {}
+        self._suggestions = []
+        self._deletions = {}
+        self._longest = 0
+
+    def load(self, pokemon):
+        aliases = defaultdict(set)
+        names = {}
+        for p in pokemon:
+            for alias in self._get_aliases(p.name, p.region):
+                aliases[alias].add(p.id)
+            names.setdefault(normalize_name(p.name), p.name)
+
+        self._aliases = {alias: frozenset(ids) for alias, ids in aliases.items()}
+        self._names = names
+
+        # Names are listed in load order, so ties are broken the same way every time
+        self._suggestions = list(names.items())
+        deletions = defaultdict(list)
+        for i, (normalized, _) in enumerate(self._suggestions):
+            for deletion in get_deletions(normalized, self.max_distance):
+                deletions[deletion].append(i)
+        self._deletions = dict(deletions)
+        self._longest = max(map(len, names), default=0)
+
+    @staticmethod
+    def _get_aliases(name, region):
+        name = name.lower()
+        names = [name]
+        gender = name[-1] if name[-2:] in [" m", " f"] else None
+        if gender:
+            base_name = name[:-2]
+            names = [
+                base_name,
+                f"{base_name} {gender}",
+                f"{base_name} {GENDERS[gender]}",
+                f"{GENDERS[gender]} {base_name}",
+            ]
+
+        aliases = set(names)
+        if region in REGIONS:
+            for region_name in [region, region[:-1]]:
+                for n in names:
+                    aliases.add(f"{region_name} {n}")
+                    aliases.add(f"{n} {region_name}")
+        return {normalize_name(alias) for alias in aliases}
+
+    def matches(self, guess, pokemon):
+        return pokemon.id in self._aliases.get(normalize_name(guess), ())
+
+    def suggest(self, guess):
+        """Closest known Pokemon name to `guess` within `max_distance` edits, if any"""
+        guess = normalize_name(guess)
+        if guess in self._names or len(guess) > self._longest + self.max_distance:
+            return None
+
+        candidates = set()
+        for deletion in get_deletions(guess, self.max_distance):
+            candidates.update(self._deletions.get(deletion, ()))
+
+        best_name, best_distance = None, self.max_distance + 1
+        for i in sorted(candidates):
+            normalized, name = self._suggestions[i]
+            distance = bounded_edit_distance(guess, normalized, best_distance - 1)
+            if distance < best_distance:
+                best_name, best_distance = name, distance
+        return best_name
@@ -0,0 +1,236 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from aiogram.utils.exceptions import RetryAfter
+
+from oakoakbot.logger import get_logger
+
+logger = get_logger()
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Longest text Telegram accepts in a single message
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second, holding up to `capacity`.
+    Tokens can be reserved ahead, leaving the bucket in debt until it refills.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now <= self.updated:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now):
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def reserve(self, now):
+        """Take a token, returning how many seconds to wait until it's available"""
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds, now):
+        """Make the next token available in `seconds` at the earliest"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundMessage:
+    __slots__ = ("priority", "order", "func", "args", "kwargs", "texts", "future")
+
+    def __init__(self, priority, order, func, args, kwargs, texts=None):
+        self.priority = priority
+        self.order = order
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.texts = texts
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other):
+        return (self.priority, self.order) < (other.priority, other.order)
+
+    @staticmethod
+    def join(texts):
+        # Coalesced messages are sent as one, without repeating identical lines
+        return "\n".join(dict.fromkeys(texts))
+
+    def can_coalesce(self, text):
+        return len(self.join(self.texts + [text])) <= MAX_MESSAGE_LENGTH
+
+    async def send(self):
+        if self.texts is None:
+            return await self.func(*self.args, **self.kwargs)
+        return await self.func(*self.args, self.join(self.texts), **self.kwargs)
+
+
+class SendScheduler:
+    """Schedule outbound Bot API calls within Telegram's flood limits.
+
+    Every chat has its own token bucket and all of them share a global one. Each chat
+    sends its queued messages one at a time, highest priority first, waiting for a
+    token of both buckets before each. A RetryAfter error pauses the chat for as long
+    as Telegram asks and the message is retried, up to `max_retries` times.
+
+    Messages queued with a `coalesce` key are merged with the message with the same
+    key still waiting on the chat queue, if there's one, so a burst of them is sent as
+    a single message. Once that message is as long as Telegram allows, the following
+    ones are merged into a new message instead.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=20 / 60, chat_burst=3, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._buckets = {}
+        self._sweep_at = 1024
+        self._queues = {}
+        self._coalescing = {}
+        self._drains = {}
+        self._order = itertools.count()
+
+    def _get_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= self._sweep_at:
+                self._sweep()
+            bucket = self._buckets[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst
+            )
+        return bucket
+
+    def _sweep(self):
+        """Drop the buckets of idle chats, they would be created full again anyway"""
+        now = time.monotonic()
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._queues and bucket.is_full(now):
+                del self._buckets[chat_id]
+        self._sweep_at = max(1024, 2 * len(self._buckets))
+
+    def try_acquire(self, chat_id):
+        """Take the tokens to send a message to a chat right away, if there are some
+        and nothing is queued for it. Used for messages sent by other means, such as
+        webhook responses, so that they count towards the limits too.
+        """
+        if chat_id in self._queues:
+            return False
+        now = time.monotonic()
+        if not self.global_bucket.try_take(now):
+            return False
+        if not self._get_bucket(chat_id).try_take(now):
+            # Give the global token back
+            self.global_bucket.tokens += 1
+            return False
+        return True
+
+    def send(self, chat_id, func, *args, priority=PRIORITY_NORMAL, **kwargs):
+        """Queue the call `func(*args, **kwargs)` sending a message to `chat_id`. The
+        returned future resolves to its result.
+        """
+        message = OutboundMessage(priority, next(self._order), func, args, kwargs)
+        return self._enqueue(chat_id, message)
+
+    def send_message(
+        self, chat_id, func, text, priority=PRIORITY_NORMAL, coalesce=None, **kwargs
+    ):
+        """Queue a text message to `chat_id` sent by `func(text, **kwargs)`, such as
+        `Message.answer`, merging it with the queued message with the same `coalesce`
+        key, if any. Messages sharing a key must share their `kwargs` too.
+        """
+        queued = self._coalescing.get(chat_id, {}).get(coalesce)
+        if coalesce is not None and queued is not None and queued.can_coalesce(text):
+            queued.texts.append(text)
+            return queued.future
+
+        message = OutboundMessage(priority, next(self._order), func, (), kwargs, [text])
+        if coalesce is not None:
+            self._coalescing.setdefault(chat_id, {})[coalesce] = message
+        return self._enqueue(chat_id, message)
+
+    def _enqueue(self, chat_id, message):
+        message.future.add_done_callback(self._log_failure)
+        heapq.heappush(self._queues.setdefault(chat_id, []), message)
+        if chat_id not in self._drains:
+            self._drains[chat_id] = asyncio.ensure_future(self._drain(chat_id))
+        return message.future
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and (exception := future.exception()) is not None:
+            logger.warning(f"Couldn't send a message: {exception}")
+
+    async def _drain(self, chat_id):
+        queue = self._queues[chat_id]
+        bucket = self._get_bucket(chat_id)
+        attempts = {}
+        try:
+            while queue:
+                # Wait for the tokens before picking the message, so the ones queued
+                # meanwhile with a higher priority go first
+                await asyncio.sleep(bucket.reserve(time.monotonic()))
+                await asyncio.sleep(self.global_bucket.reserve(time.monotonic()))
+                message = heapq.heappop(queue)
+                self._stop_coalescing(chat_id, message)
+
+                try:
+                    result = await message.send()
+                except RetryAfter as e:
+                    attempts[message] = attempts.get(message, 0) + 1
+                    if attempts[message] > self.max_retries:
+                        message.future.set_exception(e)
+                        continue
+                    logger.warning(f"Flood limit hit on chat {chat_id}, waiting {e}")
+                    bucket.pause(e.timeout, time.monotonic())
+                    heapq.heappush(queue, message)
+                    continue
+                except Exception as e:
+                    message.future.set_exception(e)
+                    continue
+                message.future.set_result(result)
+        finally:
+            for message in queue:
+                message.future.cancel()
+            del self._queues[chat_id]
+            self._coalescing.pop(chat_id, None)
+            del self._drains[chat_id]
+
+    def _stop_coalescing(self, chat_id, message):
+        coalescing = self._coalescing.get(chat_id)
+        if not coalescing:
+            return
+        for key, queued in list(coalescing.items()):
+            if queued is message:
+                del coalescing[key]
+
+    async def close(self, timeout=5):
+        """Wait up to `timeout` seconds for the queued messages to be sent"""
+        drains = list(self._drains.values())
+        if not drains:
+            return
+        _, pending = await asyncio.wait(drains, timeout=timeout)
+        for drain in pending:
+            drain.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,85 @@
+import asyncio
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot import api
+from aiogram.dispatcher.webhook import BaseResponse
+
+from oakoakbot.logger import get_logger
+
+logger = get_logger()
+
+POLLING_TIMEOUT = 20
+
+# Update fields holding a chat, and the fields holding a user for updates without one
+CHAT_UPDATES = ["message", "edited_message", "channel_post", "edited_channel_post"]
+CHAT_MEMBER_UPDATES = ["my_chat_member", "chat_member"]
+USER_UPDATES = ["inline_query", "chosen_inline_result", "shipping_query"]
+
+
+def get_update_chat_id(update: dict):
+    """Id of the chat a raw update belongs to, without deserializing the whole of it.
+    Updates that don't belong to a chat are keyed by the id of their user, or 0.
+    """
+    for field in CHAT_UPDATES + CHAT_MEMBER_UPDATES:
+        if field in update:
+            return update[field]["chat"]["id"]
+    if "callback_query" in update:
+        query = update["callback_query"]
+        if "message" in query:
+            return query["message"]["chat"]["id"]
+        return query["from"]["id"]
+    for field in USER_UPDATES:
+        if field in update:
+            return update[field]["from"]["id"]
+    return 0
+
+
+def get_shard(chat_id, num_shards):
+    return hash(chat_id) % num_shards
+
+
+async def ingest_updates(bot: Bot, queues):
+    """Long poll the Bot API and route every raw update to the queue of the worker
+    that owns its chat, so all the updates of a chat are handled by the same worker.
+    """
+    payload = {"timeout": POLLING_TIMEOUT}
+    while True:
+        try:
+            updates = await bot.request(api.Methods.GET_UPDATES, payload)
+        except Exception as e:
+            logger.warning(f"Couldn't get updates: {e}")
+            await asyncio.sleep(1)
+            continue
+
+        for update in updates:
+            shard = get_shard(get_update_chat_id(update), len(queues))
+            queues[shard].put(update)
+            # Only sent once known, as aiogram would send a None offset as "None"
+            payload["offset"] = update["update_id"] + 1
+
+
+async def process_update(dispatcher: Dispatcher, update: types.Update):
+    try:
+        results = await dispatcher.updates_handler.notify(update)
+        for responses in results:
+            for response in responses:
+                if isinstance(response, BaseResponse):
+                    await response.execute_response(dispatcher.bot)
+    except Exception:
+        logger.exception(f"Couldn't process update {update.update_id}")
+
+
+async def consume_updates(dispatcher: Dispatcher, queue):
+    """Handle the updates routed to this worker until the ingest process sends None.
+    Updates are handled concurrently, as with polling.
+    """
+    Dispatcher.set_current(dispatcher)
+    Bot.set_current(dispatcher.bot)
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    while (update := await loop.run_in_executor(None, queue.get)) is not None:
+        task = asyncio.ensure_future(process_update(dispatcher, types.Update(**update)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
@@ -0,0 +1,52 @@
+import random
+from collections import defaultdict
+
+
+class SpawnTable:
+    """In-memory index of every spawnable Pokemon and nature, so that drawing a wild
+    encounter doesn't need to query the database.
+
+    Pokemon are indexed by (generation, rarity_tier) -> numbers and by
+    (number, rarity_tier) -> species, which keeps the same weighting as the original
+    query: first a Pokemon number is picked uniformly, then one of its variants.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._numbers = {}
+        self._species = {}
+        self._candidates = {}
+        self._natures = ()
+
+    def load(self, pokemon, natures):
+        """Rebuild the table from an iterable of enabled, non-mega Pokemon and an
+        iterable of nature ids.
+        """
+        numbers = defaultdict(set)
+        species = defaultdict(list)
+        for p in pokemon:
+            numbers[(p.generation, p.rarity_tier)].add(p.number)
+            species[(p.number, p.rarity_tier)].append(p)
+
+        self._numbers = dict(numbers)
+        self._species = {key: tuple(variants) for key, variants in species.items()}
+        self._candidates = {}
+        self._natures = tuple(natures)
+        self.loaded = True
+
+    def _get_candidates(self, generations, rarity_tier):
+        key = (tuple(sorted(set(generations))), rarity_tier)
+        candidates = self._candidates.get(key)
+        if candidates is None:
+            numbers = set()
+            for gen in key[0]:
+                numbers |= self._numbers.get((gen, rarity_tier), set())
+            candidates = self._candidates[key] = tuple(sorted(numbers))
+        return candidates
+
+    def draw_pokemon(self, generations, rarity_tier):
+        number = random.choice(self._get_candidates(generations, rarity_tier))
+        return random.choice(self._species[(number, rarity_tier)])
+
+    def draw_nature(self):
+        return random.choice(self._natures)
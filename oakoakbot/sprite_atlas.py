@@ -0,0 +1,142 @@
+import functools
+import json
+import mmap
+import os
+import shutil
+import struct
+
+from oakoakbot.logger import get_logger
+
+logger = get_logger()
+
+ATLAS_VERSION = 1
+ATLAS_MAGIC = b"OAKATLAS"
+# Trailer closing every atlas: magic, version and length of the JSON index before it
+ATLAS_TRAILER = struct.Struct("<8sIQ")
+SPRITE_KINDS = ["colour", "silhouettes"]
+
+
+@functools.lru_cache(maxsize=None)
+def parse_sprite_name(name) -> tuple:
+    """Key of a sprite from its name, as (kind, number, form, region, shiny, mega,
+    gender). Silhouettes are the same for shiny and regular Pokemon, so their shiny
+    flag is always False. Raises ValueError for names that aren't sprites.
+    """
+    kind, filename = os.path.split(name)
+    stem, extension = os.path.splitext(filename)
+    parts = stem.split("_")
+    if kind == "colour" and len(parts) == 6:
+        number, form, region, shiny, mega, gender = parts
+    elif kind == "silhouettes" and len(parts) == 5:
+        number, form, region, mega, gender = parts
+        shiny = "n"
+    else:
+        raise ValueError(f"{name} is not a sprite name")
+    if extension != ".jpg":
+        raise ValueError(f"{name} is not a sprite name")
+    return kind, int(number), int(form), region, shiny == "s", mega == "m", gender
+
+
+def write_atlas(path, sprites):
+    """Pack sprite files into an atlas at `path`.
+
+    `sprites` yields (key, filename) pairs. The sprites are written back to back,
+    followed by their JSON index and a fixed size trailer locating it. The atlas is
+    written next to its final location and moved into place in a single rename, so
+    readers see either the whole previous atlas or the whole new one, and a bot that
+    already has the previous atlas mapped keeps reading it until it reopens it.
+    """
+    entries = []
+    offset = 0
+    with open(f"{path}.tmp", "wb") as atlas:
+        for key, filename in sprites:
+            with open(filename, "rb") as sprite:
+                shutil.copyfileobj(sprite, atlas)
+            length = atlas.tell() - offset
+            entries.append([*key, offset, length])
+            offset += length
+
+        index = json.dumps({"size": offset, "sprites": entries}).encode()
+        atlas.write(index)
+        atlas.write(ATLAS_TRAILER.pack(ATLAS_MAGIC, ATLAS_VERSION, len(index)))
+    os.replace(f"{path}.tmp", path)
+    return len(entries)
+
+
+class SpriteAtlas:
+    """Read-only view of a packed sprite atlas.
+
+    The atlas is one file holding every sprite back to back, then a JSON index from
+    sprite key to its (offset, length) and a trailer locating the index. The file
+    is memory mapped, and
+    sprites are handed out as zero-copy memoryview slices of the mapping, so reading
+    a sprite costs no syscalls and the page cache is the only copy in memory.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as atlas:
+            size = os.fstat(atlas.fileno()).st_size
+            if size < ATLAS_TRAILER.size:
+                raise ValueError(f"Sprite atlas {path} is truncated")
+            atlas.seek(size - ATLAS_TRAILER.size)
+            magic, version, index_length = ATLAS_TRAILER.unpack(
+                atlas.read(ATLAS_TRAILER.size)
+            )
+            if magic != ATLAS_MAGIC:
+                raise ValueError(f"{path} is not a sprite atlas")
+            if version != ATLAS_VERSION:
+                raise ValueError(f"Unsupported sprite atlas version {version}")
+
+            data_size = size - ATLAS_TRAILER.size - index_length
+            if data_size < 0:
+                raise ValueError(f"Sprite atlas {path} is truncated")
+            atlas.seek(data_size)
+            index = json.loads(atlas.read(index_length))
+            if index["size"] != data_size:
+                raise ValueError(
+                    f"Sprite atlas {path} holds {data_size} bytes of sprites, its "
+                    f"index expects {index['size']}"
+                )
+            self._mmap = mmap.mmap(atlas.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        self._index = {
+            tuple(entry[:-2]): (entry[-2], entry[-1]) for entry in index["sprites"]
+        }
+
+    @classmethod
+    def open(cls, path):
+        """Open the atlas at `path`, or return None if there isn't a usable one, in
+        which case sprites are read from their own files
+        """
+        if not os.path.isfile(path):
+            return None
+        try:
+            return cls(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring sprite atlas {path}: {e}")
+            return None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def get(self, key):
+        location = self._index.get(key)
+        if location is None:
+            return None
+        offset, length = location
+        return self._view[offset : offset + length]
+
+    def prefetch(self, key):
+        """Ask the kernel to start reading a sprite's pages, without waiting for it"""
+        location = self._index.get(key)
+        if location is None or not hasattr(mmap, "MADV_WILLNEED"):
+            return
+        offset, length = location
+        start = offset - offset % mmap.PAGESIZE
+        self._mmap.madvise(mmap.MADV_WILLNEED, start, offset + length - start)
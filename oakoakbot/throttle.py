@@ -0,0 +1,55 @@
+import time
+from collections import OrderedDict
+
+
+class SlidingWindowLimiter:
+    """Allow up to `limit` hits per key within any `window` seconds.
+
+    The window is approximated from the counts of the current and the previous fixed
+    windows, weighting the previous count by how much of it still overlaps the sliding
+    window, so each key only takes a few numbers. A key that goes over the limit is
+    blocked for `cooldown` seconds, without counting the hits dropped meanwhile.
+
+    At most `max_keys` keys are tracked, evicting the least recently used ones.
+    """
+
+    def __init__(self, limit, window, cooldown=0, max_keys=65536):
+        self.limit = limit
+        self.window = window
+        self.cooldown = cooldown
+        self.max_keys = max_keys
+        # key -> [window index, previous window count, current window count,
+        #         blocked until]
+        self._counters = OrderedDict()
+
+    def __len__(self):
+        return len(self._counters)
+
+    def hit(self, key, now=None):
+        """Count a hit for `key`, returning whether it's within the limit"""
+        if now is None:
+            now = time.monotonic()
+        index, position = divmod(now, self.window)
+
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = [index, 0, 0, 0.0]
+            if len(self._counters) > self.max_keys:
+                self._counters.popitem(last=False)
+        else:
+            self._counters.move_to_end(key)
+
+        if now < counter[3]:
+            return False
+        if counter[0] != index:
+            # Roll the windows, forgetting both counts after a window without hits
+            counter[1] = counter[2] if index - counter[0] == 1 else 0
+            counter[2] = 0
+            counter[0] = index
+
+        overlap = 1 - position / self.window
+        if counter[1] * overlap + counter[2] >= self.limit:
+            counter[3] = now + self.cooldown
+            return False
+        counter[2] += 1
+        return True
@@ -0,0 +1,71 @@
+import asyncio
+import math
+import time
+
+from oakoakbot.logger import get_logger
+
+logger = get_logger()
+
+
+class TimerWheel:
+    """Hashed timer wheel that runs all its timers from a single asyncio task.
+
+    Deadlines are hashed into `span / resolution` slots. Every `resolution` seconds
+    the wheel advances one slot and calls `callback` once with the keys of all the
+    timers that expired in it, so thousands of timers cost one task and one wakeup
+    per tick. Scheduling and cancelling a timer are O(1).
+    """
+
+    def __init__(self, span, callback, resolution=1.0):
+        self.callback = callback
+        self.resolution = resolution
+        self._slots = [{} for _ in range(math.ceil(span / resolution) + 1)]
+        self._slot_of = {}
+        self._tick = self._tick_of(time.time()) - 1
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def _tick_of(self, timestamp):
+        return int(timestamp // self.resolution)
+
+    def schedule(self, key, deadline):
+        """Schedule (or reschedule) the timer identified by `key`"""
+        self.cancel(key)
+        slot = max(self._tick_of(deadline), self._tick + 1) % len(self._slots)
+        self._slots[slot][key] = deadline
+        self._slot_of[key] = slot
+
+    def cancel(self, key):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def _advance(self, now):
+        """Collect every timer expired since the last tick, at most one full turn"""
+        expired = []
+        current_tick = self._tick_of(now)
+        first_tick = max(self._tick + 1, current_tick - len(self._slots) + 1)
+        for tick in range(first_tick, current_tick):
+            slot = self._slots[tick % len(self._slots)]
+            for key, deadline in list(slot.items()):
+                # Timers hashed into this slot for a later turn of the wheel stay
+                if deadline <= now:
+                    del slot[key]
+                    del self._slot_of[key]
+                    expired.append(key)
+        self._tick = max(self._tick, current_tick - 1)
+        return expired
+
+    async def run(self):
+        while True:
+            next_tick = (self._tick + 2) * self.resolution
+            await asyncio.sleep(max(0, next_tick - time.time()))
+
+            expired = self._advance(time.time())
+            if not expired:
+                continue
+            try:
+                await self.callback(expired)
+            except Exception:
+                logger.exception(f"Timer wheel callback failed for {len(expired)} keys")
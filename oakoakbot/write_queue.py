@@ -0,0 +1,93 @@
+import asyncio
+import contextvars
+
+
+class WriteBehindQueue:
+    """Collect database writes and apply them in batches, one transaction per batch.
+
+    Callers await `submit`, which only returns once the transaction holding their
+    write has been committed. A crash can therefore only lose writes that were never
+    acknowledged, while a burst of writes still costs a single fsync. A batch is
+    flushed after `flush_interval` seconds or as soon as it reaches `max_batch`
+    writes, whichever happens first. `on_rollback` is called if a whole batch had to
+    be rolled back, so that callers can drop any state cached from it.
+    """
+
+    def __init__(
+        self, database, executor, flush_interval=0.05, max_batch=100, on_rollback=None
+    ):
+        self.database = database
+        self.executor = executor
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.on_rollback = on_rollback
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+
+    async def submit(self, func, *args, **kwargs):
+        """Queue `func(*args, **kwargs)` to be run inside the next batch transaction
+        and wait until it has been committed.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        context = contextvars.copy_context()
+        self._pending.append((func, args, kwargs, context, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._start_flush)
+
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            results = await self.executor.write(self._apply, batch)
+        except Exception as e:
+            if self.on_rollback is not None:
+                self.on_rollback()
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (*_, future), (result, exception) in zip(batch, results):
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def _apply(self, batch):
+        """Run a batch of writes in one transaction. Each write gets its own savepoint
+        so a failing one doesn't roll back the rest of the batch.
+        """
+        results = []
+        with self.database.atomic():
+            for func, args, kwargs, context, _ in batch:
+                try:
+                    with self.database.atomic():
+                        results.append((context.run(func, *args, **kwargs), None))
+                except Exception as e:
+                    results.append((None, e))
+        return results
+
+    async def close(self):
+        """Flush every pending write and wait for all in-flight batches"""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
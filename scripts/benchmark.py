@@ -0,0 +1,255 @@
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+
+from aiogram import types
+
+from oakoakbot.db import (
+    db,
+    db_executor,
+    groups_config,
+    init_database,
+    load_spawn_table,
+    teams_cache,
+    write_queue,
+    CaughtPokemon,
+    GroupsConfiguration,
+    Pokemon,
+    PokemonNatures,
+)
+from oakoakbot.images import SPRITES_FOLDER, load_pokemon_images
+
+POKEMON_CSV = "data/pokemon_data/pokemon.csv"
+NATURES_CSV = "data/pokemon_data/natures.csv"
+RARITY_TIERS = ["ultra-rare", "rare", "common", "ultra-common"]
+
+
+class FakeMessage:
+    """Stand-in for an aiogram Message that counts answers instead of calling the
+    Telegram Bot API, so handlers can be benchmarked offline.
+    """
+
+    def __init__(self, chat_id, user_id, args=""):
+        self.chat = types.Chat(id=chat_id, type=types.ChatType.GROUP)
+        self.from_user = types.User(id=user_id, first_name=f"User {user_id}")
+        self.args = args
+        self.answers = 0
+
+    def get_args(self):
+        return self.args
+
+    async def answer(self, *args, **kwargs):
+        self.answers += 1
+
+    async def answer_photo(self, *args, **kwargs):
+        self.answers += 1
+
+
+def percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, len(sorted_values) * percent // 100)
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "iterations": len(latencies),
+        "ops_per_sec": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 4),
+        "max_ms": round(latencies[-1] * 1000, 4),
+    }
+
+
+def measure(func, iterations):
+    latencies = []
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        call_t0 = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - call_t0)
+    return summarize(latencies, time.perf_counter() - t0)
+
+
+async def measure_async(func, iterations, concurrency=1):
+    """Measure an async callable, running `concurrency` calls at the same time"""
+    latencies = []
+
+    async def timed_call():
+        call_t0 = time.perf_counter()
+        await func()
+        latencies.append(time.perf_counter() - call_t0)
+
+    t0 = time.perf_counter()
+    for batch_start in range(0, iterations, concurrency):
+        batch_size = min(concurrency, iterations - batch_start)
+        await asyncio.gather(*[timed_call() for _ in range(batch_size)])
+    return summarize(latencies, time.perf_counter() - t0)
+
+
+async def run_benchmarks(
+    num_groups, num_users, iterations, names_are_equivalent, handlers
+):
+    group_ids = [-(1000000 + i) for i in range(num_groups)]
+    user_ids = [1000000 + i for i in range(num_users)]
+    generations = list(range(1, 9))
+    results = {}
+
+    with db.atomic():
+        for group_id in group_ids:
+            GroupsConfiguration.add_group(group_id)
+
+    results["get_random_encounter"] = measure(
+        lambda: Pokemon.get_random_encounter(
+            generations, random.choice(RARITY_TIERS), False
+        ),
+        iterations,
+    )
+    encounters = [
+        Pokemon.get_random_encounter(generations, random.choice(RARITY_TIERS))
+        for _ in range(100)
+    ]
+
+    results["catch_pokemon"] = await measure_async(
+        lambda: CaughtPokemon.catch_pokemon(
+            random.choice(encounters), random.choice(user_ids), random.choice(group_ids)
+        ),
+        iterations,
+        concurrency=min(num_users, 100),
+    )
+    teams_cache.clear()
+    results["catch_pokemon_cold_team"] = await measure_async(
+        lambda: CaughtPokemon.catch_pokemon(
+            random.choice(encounters), random.choice(user_ids), random.choice(group_ids)
+        ),
+        min(iterations, num_users),
+    )
+    results["get_caught_pokemon"] = await measure_async(
+        lambda: CaughtPokemon.get_caught_pokemon(
+            random.choice(user_ids), random.choice(group_ids)
+        ),
+        iterations,
+    )
+    results["get_team_page"] = await measure_async(
+        lambda: CaughtPokemon.get_team_page(
+            random.choice(user_ids), random.choice(group_ids), 0, 50
+        ),
+        iterations,
+    )
+
+    results["get_pokemon_rate"] = measure(
+        lambda: GroupsConfiguration.get_pokemon_rate(random.choice(group_ids)),
+        iterations,
+    )
+    results["get_generations"] = measure(
+        lambda: GroupsConfiguration.get_generations(random.choice(group_ids)),
+        iterations,
+    )
+
+    def get_uncached_config():
+        group_id = random.choice(group_ids)
+        groups_config.pop(group_id, None)
+        GroupsConfiguration.get_config(group_id)
+
+    results["get_config_uncached"] = measure(get_uncached_config, iterations)
+
+    def load_images():
+        encounter = random.choice(encounters)
+        load_pokemon_images(
+            encounter.pokemon.number,
+            encounter.pokemon.form,
+            encounter.pokemon.region,
+            encounter.shiny,
+            encounter.pokemon.mega,
+            encounter.pokemon.gender,
+        )
+
+    if os.path.isdir(os.path.join(SPRITES_FOLDER, "colour")):
+        results["load_pokemon_images"] = measure(load_images, iterations)
+    else:
+        results["load_pokemon_images"] = {"skipped": f"No sprites in {SPRITES_FOLDER}"}
+
+    if names_are_equivalent is not None:
+        guesses = [(e.pokemon.name.upper(), e) for e in encounters]
+        guesses += [(f"{e.pokemon.name}!", e) for e in encounters]
+        guesses += [("missingno", e) for e in encounters]
+        results["pokemon_names_are_equivalent"] = measure(
+            lambda: names_are_equivalent(*random.choice(guesses)), iterations
+        )
+
+    if "message_handler" in handlers:
+        # A zero spawn rate measures the cost every regular group message pays
+        quiet_group = group_ids[0]
+        GroupsConfiguration.set_pokemon_rate(quiet_group, 0)
+        results["message_handler"] = await measure_async(
+            lambda: handlers["message_handler"](
+                FakeMessage(quiet_group, random.choice(user_ids))
+            ),
+            iterations,
+        )
+    if "catch_handler" in handlers:
+        results["catch_handler_wrong_guess"] = await measure_async(
+            lambda: handlers["catch_handler"](
+                FakeMessage(group_ids[0], random.choice(user_ids), "pikachuu")
+            ),
+            iterations,
+        )
+
+    await write_queue.close()
+    return results
+
+
+def check_performance(
+    num_groups=100,
+    num_users=1000,
+    iterations=1000,
+    output=None,
+    names_are_equivalent=None,
+    handlers=None,
+):
+    """Benchmark the message path against a temporary database and print the results
+    as JSON, or write them to `output`.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db.close()
+        db.init(os.path.join(tmp_dir, "benchmark.sqlite3"))
+        init_database()
+        groups_config.clear()
+        teams_cache.clear()
+
+        load_t0 = time.perf_counter()
+        Pokemon.init_table_from_csv(POKEMON_CSV)
+        PokemonNatures.init_table_from_csv(NATURES_CSV)
+        load_spawn_table()
+        load_time = time.perf_counter() - load_t0
+
+        results = asyncio.run(
+            run_benchmarks(
+                num_groups, num_users, iterations, names_are_equivalent, handlers or {}
+            )
+        )
+        db_executor.shutdown()
+        db.close()
+
+    report = {
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "groups": num_groups,
+        "users": num_users,
+        "iterations": iterations,
+        "init_db_seconds": round(load_time, 4),
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return report
@@ -1,59 +1,164 @@
-from oakoakbot.db import Pokemon
-import glob
+import json
 import os
+import time
+from collections import defaultdict
+
+from oakoakbot.db import Pokemon
+from oakoakbot.images import SPRITE_ATLAS_PATH, SPRITES_FOLDER, get_sprite_names
+from oakoakbot.sprite_atlas import SPRITE_KINDS, SpriteAtlas, parse_sprite_name
 
 BASE_PATH = "data/images/pokemon"
+# Pokemon with gender differences have one image per gender instead of a single one
+GENDERED_IMAGES = {"md", "fd"}
 
 
-def validate_data():
-    im_pokemon = glob.glob(os.path.join(BASE_PATH, "*"))
-    db_pokemon = Pokemon.select().where(Pokemon.enabled == 1).execute()
+def scan_source_images(folder):
+    """Parse the names of the source images in a single directory scan.
 
-    # First, check that all Pokemon on the database have all images
-    pokemon_without_image = []
-    for pokemon in db_pokemon:
-        f_normal = (
-            f"{pokemon.number:04}_{pokemon.form:02}_{pokemon.region}_n_"
-            f"{['n','m'][pokemon.mega]}_*.png"
-        )
-        f_shiny = (
-            f"{pokemon.number:04}_{pokemon.form:02}_{pokemon.region}_s_"
-            f"{['n','m'][pokemon.mega]}_*.png"
-        )
-        finds_normal = glob.glob(os.path.join("data/images/pokemon", f_normal))
-        finds_shiny = glob.glob(os.path.join("data/images/pokemon", f_shiny))
-        if len(finds_normal) != len(finds_shiny):
-            pokemon_without_image.append(pokemon)
-        elif len(finds_normal) == 0:
-            pokemon_without_image.append(pokemon)
-        elif len(finds_normal) == 2:
-            for fn, fs in zip(finds_normal, finds_shiny):
-                if "_md" not in fn and "_fd" not in fn:
-                    pokemon_without_image.append(pokemon)
-                if "_md" not in fs and "_fd" not in fs:
-                    pokemon_without_image.append(pokemon)
-
-    # Then, check that all images are correctly registered in the db.
-    images_without_pokemon = []
-    for pokemon in im_pokemon:
-        att = pokemon.split("/")[-1].split("_")
-        num = int(att[0])
-        form = int(att[1])
-        region = att[2]
-        mega = att[4] == "m"
-
-        a = list(
-            Pokemon.select().where(
-                (
-                    (Pokemon.number == num)
-                    & (Pokemon.form == form)
-                    & (Pokemon.region == region)
-                    & (Pokemon.mega == mega)
-                )
-            )
+    Returns a map from (number, form, region, mega) to the set of genders found per
+    shiny flag, and the names that couldn't be parsed.
+    """
+    images = defaultdict(lambda: defaultdict(set))
+    invalid = []
+    for entry in os.scandir(folder) if os.path.isdir(folder) else []:
+        try:
+            number, form, region, shiny, mega, gender = entry.name[:-4].split("_")
+            key = (int(number), int(form), region, mega == "m")
+        except ValueError:
+            invalid.append(entry.name)
+            continue
+        if not entry.name.endswith(".png"):
+            invalid.append(entry.name)
+            continue
+        images[key][shiny == "s"].add(gender)
+    return images, invalid
+
+
+def scan_sprites(folder):
+    """Parse the keys of the rendered sprites, and return them with the names that
+    couldn't be parsed.
+    """
+    sprites = set()
+    invalid = []
+    for kind in SPRITE_KINDS:
+        kind_folder = os.path.join(folder, kind)
+        for entry in os.scandir(kind_folder) if os.path.isdir(kind_folder) else []:
+            name = os.path.join(kind, entry.name)
+            try:
+                sprites.add(parse_sprite_name(name))
+            except ValueError:
+                invalid.append(name)
+    return sprites, invalid
+
+
+def describe(pokemon):
+    return {
+        "id": pokemon.id,
+        "name": pokemon.name,
+        "number": pokemon.number,
+        "form": pokemon.form,
+        "region": pokemon.region,
+        "mega": pokemon.mega,
+    }
+
+
+def validate_data(
+    source_folder=BASE_PATH, sprites_folder=SPRITES_FOLDER, atlas_path=SPRITE_ATLAS_PATH
+):
+    """Check that the Pokemon table, the source images and the rendered sprites
+    agree with each other.
+
+    Returns a report with the number of checked items and the problems found, keyed
+    by kind of problem. The data is valid if every list of problems is empty.
+    """
+    t0 = time.perf_counter()
+    pokemon = list(
+        Pokemon.select(
+            Pokemon.id,
+            Pokemon.name,
+            Pokemon.number,
+            Pokemon.form,
+            Pokemon.region,
+            Pokemon.mega,
+            Pokemon.gender,
+            Pokemon.enabled,
         )
-        if len(a) == 0:
-            images_without_pokemon.append((num, form))
+    )
+    enabled = [p for p in pokemon if p.enabled]
+
+    source_images, invalid_source_images = scan_source_images(source_folder)
+    sprites, invalid_sprites = scan_sprites(sprites_folder)
+    atlas = SpriteAtlas.open(atlas_path)
+    atlas_sprites = set(atlas.keys()) if atlas is not None else set()
+
+    # Every enabled Pokemon needs the same images for its regular and shiny versions,
+    # either a single one or one per gender
+    pokemon_without_image = []
+    for p in enabled:
+        genders = source_images.get((p.number, p.form, p.region, p.mega), {})
+        regular, shiny = genders.get(False, set()), genders.get(True, set())
+        if (
+            not regular
+            or regular != shiny
+            or (len(regular) > 1 and not regular <= GENDERED_IMAGES)
+        ):
+            pokemon_without_image.append(describe(p))
+
+    # Every source image needs a Pokemon on the database
+    known_pokemon = {(p.number, p.form, p.region, p.mega) for p in pokemon}
+    images_without_pokemon = [
+        {"number": number, "form": form, "region": region, "mega": mega}
+        for number, form, region, mega in sorted(source_images.keys() - known_pokemon)
+    ]
+
+    # Every enabled Pokemon needs the sprites the bot loads for it
+    expected_sprites = {}
+    for p in enabled:
+        for shiny in [False, True]:
+            for name in get_sprite_names(
+                p.number, p.form, p.region, shiny, p.mega, p.gender
+            ):
+                expected_sprites[parse_sprite_name(name)] = name
+    available_sprites = sprites | atlas_sprites
+    missing_sprites = sorted(
+        expected_sprites[key] for key in expected_sprites.keys() - available_sprites
+    )
+    unused_sprites = len(available_sprites - expected_sprites.keys())
+    # Sprites rendered after the atlas was packed are still read from their files
+    sprites_not_in_atlas = len(sprites - atlas_sprites) if atlas is not None else 0
+
+    errors = {
+        "pokemon_without_image": pokemon_without_image,
+        "images_without_pokemon": images_without_pokemon,
+        "invalid_source_images": sorted(invalid_source_images),
+        "missing_sprites": missing_sprites,
+        "invalid_sprites": sorted(invalid_sprites),
+    }
+    return {
+        "valid": not any(errors.values()),
+        "seconds": round(time.perf_counter() - t0, 4),
+        "checked": {
+            "pokemon": len(pokemon),
+            "enabled_pokemon": len(enabled),
+            "source_images": sum(
+                len(genders)
+                for shiny_genders in source_images.values()
+                for genders in shiny_genders.values()
+            ),
+            "sprites": len(sprites),
+            "atlas_sprites": len(atlas_sprites),
+        },
+        "warnings": {
+            "unused_sprites": unused_sprites,
+            "sprites_not_in_atlas": sprites_not_in_atlas,
+        },
+        "errors": errors,
+    }
+
 
-    print(pokemon_without_image)
-    print(images_without_pokemon)
+def print_report(report, output=None):
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,17 +1,31 @@
-import glob
-import io
+import hashlib
+import json
 import math
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
+from oakoakbot.db import Pokemon
+from oakoakbot.images import SPRITE_ATLAS_PATH
+from oakoakbot.logger import get_logger
+from oakoakbot.sprite_atlas import SPRITE_KINDS, parse_sprite_name, write_atlas
+
+logger = get_logger()
+
 SPRITES_FOLDER = os.environ.get("IMAGES_PATH", "data/images")
 
 BASE_PATH = "data/images/pokemon"
 BASE_IMAGE = "data/images/misc/background_image.jpg"
 POKEMON_LOGO = "data/images/misc/pokemon_logo.png"
 QUESTION_MARK = "data/images/misc/question_mark.png"
+FONT = "data/fonts/Playhouse Medium.ttf"
+MANIFEST_FILE = ".preprocess_manifest.json"
+
+# Bump whenever the card design changes in code to force a full rebuild
+RENDER_VERSION = 1
 
 COLOURS = {
     "blue": (22, 104, 151, 255),
@@ -23,63 +37,91 @@ COLOURS = {
 SHADOW_OFFSET = (15, 12)
 CONTOUR_OFFSET = (20, 15)
 
+# Shared assets, loaded once per worker process by `load_assets`
+assets = {}
 
-def silhouette_from_image(image, rgba):
-    mask = (np.array(image)[..., 3] > 0).astype(np.uint8)
-    return Image.fromarray(np.stack([colour * mask for colour in rgba], 2))
 
+def load_assets():
+    base_image = Image.open(BASE_IMAGE).convert("RGB")
 
-def paste_image_with_shadow(base_image, image, position):
-    shadow = silhouette_from_image(image, COLOURS["shadow"])
-    blue_contour = silhouette_from_image(image, COLOURS["darker_blue"])
+    pokemon_logo = Image.open(POKEMON_LOGO).convert("RGBA")
+    pokemon_logo.thumbnail([math.ceil(dim * 0.5) for dim in pokemon_logo.size])
+    pokemon_logo = pokemon_logo.crop(pokemon_logo.getbbox())
+
+    question_mark = Image.open(QUESTION_MARK).convert("RGBA")
+    question_mark.thumbnail([math.ceil(dim * 0.75) for dim in question_mark.size])
+    question_mark = question_mark.crop(question_mark.getbbox())
 
-    base_image.paste(shadow, position, shadow)
-    base_image.paste(
-        blue_contour,
-        (position[0] + SHADOW_OFFSET[0], position[1] - SHADOW_OFFSET[1]),
-        blue_contour,
+    # Static overlays are pre-rendered with their shadows as ready-to-paste tiles
+    assets.update(
+        base_image=base_image,
+        pokemon_logo=render_with_shadow(pokemon_logo),
+        question_mark=render_with_shadow(question_mark),
+        font=ImageFont.truetype(FONT, 100),
     )
-    base_image.paste(
-        image, (position[0] + CONTOUR_OFFSET[0], position[1] - CONTOUR_OFFSET[1]), image
+
+
+def render_with_shadow(image, fill=None):
+    """Render an image together with its shadow and contour into a single RGBA tile.
+
+    The alpha mask is computed once, and the shadow, contour and optional `fill`
+    layers are produced from it in a single broadcast operation. With `fill`, the
+    image itself is replaced by its silhouette in that colour.
+    """
+    mask = np.asarray(image)[..., 3:] > 0
+    colours = [COLOURS["shadow"], COLOURS["darker_blue"]] + ([fill] if fill else [])
+    layers = mask * np.array(colours, dtype=np.uint8)[:, None, None, :]
+
+    height, width = mask.shape[:2]
+    tile = Image.new(
+        "RGBA", (width + CONTOUR_OFFSET[0], height + CONTOUR_OFFSET[1]), (0, 0, 0, 0)
+    )
+    tile.alpha_composite(Image.fromarray(layers[0]), (0, CONTOUR_OFFSET[1]))
+    tile.alpha_composite(
+        Image.fromarray(layers[1]),
+        (SHADOW_OFFSET[0], CONTOUR_OFFSET[1] - SHADOW_OFFSET[1]),
+    )
+    tile.alpha_composite(
+        Image.fromarray(layers[2]) if fill else image, (CONTOUR_OFFSET[0], 0)
     )
+    return tile
+
+
+def paste_tile(base_image, tile, position):
+    """Paste a tile made by `render_with_shadow`, with its shadow at `position`"""
+    base_image.paste(tile, (position[0], position[1] - CONTOUR_OFFSET[1]), tile)
 
 
 def create_pokemon_image(pokemon_image, pokemon_name, is_silhouette):
     # Load base image
-    base_image = Image.open(BASE_IMAGE).convert("RGB")
+    base_image = assets["base_image"].copy()
 
     # Create pokemon image or silhouettes with shadows
     pokemon_image = Image.open(pokemon_image).convert("RGBA")
     pokemon_image = pokemon_image.crop(pokemon_image.getbbox())
-    if is_silhouette:
-        pokemon_image = silhouette_from_image(pokemon_image, COLOURS["blue"])
+    pokemon_tile = render_with_shadow(
+        pokemon_image, COLOURS["blue"] if is_silhouette else None
+    )
 
     # Calculate pokemon position
     w_start = max(10, math.ceil(base_image.size[0] * 0.25 - pokemon_image.size[0] / 2))
     h_start = max(10, math.ceil(base_image.size[1] * 0.4 - pokemon_image.size[1] / 2))
 
     # Paste the pokemon image into the background
-    paste_image_with_shadow(base_image, pokemon_image, (w_start, h_start))
+    paste_tile(base_image, pokemon_tile, (w_start, h_start))
 
     # Paste pokemon logo
-    pokemon_logo = Image.open(POKEMON_LOGO).convert("RGBA")
-    pokemon_logo.thumbnail([math.ceil(dim * 0.5) for dim in pokemon_logo.size])
-    pokemon_logo = pokemon_logo.crop(pokemon_logo.getbbox())
-    paste_image_with_shadow(
+    paste_tile(
         base_image,
-        pokemon_logo,
+        assets["pokemon_logo"],
         (math.ceil(base_image.size[0] * 0.45), math.ceil(base_image.size[1] * 0.6)),
     )
 
     if is_silhouette:
-        # Paste pokemon logo
-        question_mark = Image.open(QUESTION_MARK).convert("RGBA")
-
-        question_mark.thumbnail([math.ceil(dim * 0.75) for dim in question_mark.size])
-        question_mark = question_mark.crop(question_mark.getbbox())
-        paste_image_with_shadow(
+        # Paste question mark
+        paste_tile(
             base_image,
-            question_mark,
+            assets["question_mark"],
             (
                 math.ceil(base_image.size[0] * 0.6),
                 math.ceil(base_image.size[1] * 0.15),
@@ -90,7 +132,7 @@ def create_pokemon_image(pokemon_image, pokemon_name, is_silhouette):
         text_image = Image.new("RGBA", (800, 300), (255, 255, 255, 0))
         contour_image = Image.new("RGBA", (800, 300), (255, 255, 255, 0))
 
-        font = ImageFont.truetype("data/fonts/Playhouse Medium.ttf", 100)
+        font = assets["font"]
         text_pos = (400, 150)
 
         draw = ImageDraw.Draw(text_image)
@@ -114,12 +156,10 @@ def create_pokemon_image(pokemon_image, pokemon_name, is_silhouette):
             stroke_width=5,
             stroke_fill=COLOURS["yellow"],
         )
-        # text_image.show()
         text_image = Image.alpha_composite(text_image, contour_image)
-        text_image.crop(text_image.getbbox())
-        paste_image_with_shadow(
+        paste_tile(
             base_image,
-            text_image,
+            render_with_shadow(text_image),
             (
                 math.ceil(base_image.size[0] * 0.71 - text_image.size[0] * 0.5),
                 math.ceil(base_image.size[1] * 0.33 - text_image.size[1] * 0.5),
@@ -128,40 +168,157 @@ def create_pokemon_image(pokemon_image, pokemon_name, is_silhouette):
 
     # Resize the image to reduce image size
     base_image.thumbnail([math.ceil(dim * 0.6) for dim in base_image.size])
+    return base_image
 
-    # Save it to bytes buffer
-    with io.BytesIO() as output:
-        base_image.save(output, format="GIF")
-        bytes_image = output.getvalue()
 
-    return base_image
+def render_sprite(source, pokemon_name, is_silhouette, destination):
+    """Render a single card and save it. Runs on the worker processes."""
+    image = create_pokemon_image(source, pokemon_name, is_silhouette)
+    tmp_destination = f"{destination}.tmp"
+    image.save(tmp_destination, format="JPEG")
+    os.replace(tmp_destination, destination)
+    return destination
 
 
-def preprocess_images(pokemon_list, destination_folder):
-    for pokemon in pokemon_list:
-        # Get normal and shiny filenames
-        f_normal = (
-            f"{pokemon.number:04}_{pokemon.form:02}_{pokemon.region}_n_"
-            f"{['n', 'm'][pokemon.mega]}_*.png"
-        )
-        f_shiny = (
-            f"{pokemon.number:04}_{pokemon.form:02}_{pokemon.region}_s_"
-            f"{['n', 'm'][pokemon.mega]}_*.png"
+def file_hash(filename):
+    with open(filename, "rb") as file:
+        return hashlib.blake2b(file.read(), digest_size=16).hexdigest()
+
+
+def get_assets_hash():
+    assets_hash = hashlib.blake2b(str(RENDER_VERSION).encode(), digest_size=16)
+    for asset in [BASE_IMAGE, POKEMON_LOGO, QUESTION_MARK, FONT]:
+        assets_hash.update(file_hash(asset).encode())
+    return assets_hash.hexdigest()
+
+
+def get_jobs(source_folder):
+    """List every card to render as (output name, source, pokemon name, silhouette)"""
+    names = {
+        (p.number, p.form, p.region, p.mega): p.name
+        for p in Pokemon.select(
+            Pokemon.number, Pokemon.form, Pokemon.region, Pokemon.mega, Pokemon.name
         )
+    }
 
-        for find in glob.glob(os.path.join(BASE_PATH, f_normal)):
-            image = create_pokemon_image(find, pokemon.name, False)
-            image.save(
-                os.path.join(destination_folder, "images", os.path.basename(find))
-            )
+    jobs = []
+    for entry in os.scandir(source_folder):
+        if not entry.name.endswith(".png"):
+            continue
+        try:
+            number, form, region, shiny, mega, gender = entry.name[:-4].split("_")
+            key = (int(number), int(form), region, mega == "m")
+        except ValueError:
+            logger.warning(f"Skipping {entry.name}, it's not a valid image name")
+            continue
+        name = names.get(key)
+        if name is None:
+            logger.warning(f"Skipping {entry.name}, it has no Pokemon on the database")
+            continue
 
-            image = create_pokemon_image(find, pokemon.name, True)
-            image.save(
-                os.path.join(destination_folder, "silhouettes", os.path.basename(find))
+        colour_name = f"{number}_{form}_{region}_{shiny}_{mega}_{gender}.jpg"
+        jobs.append((os.path.join("colour", colour_name), entry.path, name, False))
+        if shiny == "n":
+            silhouette_name = f"{number}_{form}_{region}_{mega}_{gender}.jpg"
+            jobs.append(
+                (os.path.join("silhouettes", silhouette_name), entry.path, name, True)
             )
+    return jobs
 
-        for find in glob.glob(os.path.join(BASE_PATH, f_shiny)):
-            image = create_pokemon_image(find, pokemon.name, False)
-            image.save(
-                os.path.join(destination_folder, "images", os.path.basename(find))
-            )
+
+def pack_sprites(sprites_folder, atlas_path):
+    """Pack every rendered card into the sprite atlas the bot reads them from"""
+    sprites = []
+    for kind in SPRITE_KINDS:
+        for entry in os.scandir(os.path.join(sprites_folder, kind)):
+            try:
+                key = parse_sprite_name(os.path.join(kind, entry.name))
+            except ValueError:
+                continue
+            sprites.append((key, entry.path))
+    sprites.sort()
+    return write_atlas(atlas_path, sprites)
+
+
+def preprocess_images(
+    source_folder=BASE_PATH,
+    destination_folder=SPRITES_FOLDER,
+    workers=None,
+    force=False,
+    atlas_path=SPRITE_ATLAS_PATH,
+):
+    """Render the colour and silhouette cards of every Pokemon image on a process
+    pool. Cards whose source image, Pokemon name and shared assets haven't changed
+    since the last run are skipped, unless `force` is set. All the cards are then
+    packed into the sprite atlas at `atlas_path`.
+    """
+    t0 = time.time()
+    for folder in ["colour", "silhouettes"]:
+        os.makedirs(os.path.join(destination_folder, folder), exist_ok=True)
+
+    manifest_path = os.path.join(destination_folder, MANIFEST_FILE)
+    manifest = {}
+    if os.path.isfile(manifest_path) and not force:
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+
+    assets_hash = get_assets_hash()
+    pending = []
+    for output_name, source, pokemon_name, is_silhouette in get_jobs(source_folder):
+        source_mtime = os.stat(source).st_mtime
+        entry = manifest.get(output_name)
+        if (
+            entry is not None
+            and entry["assets"] == assets_hash
+            and entry["name"] == pokemon_name
+            and os.path.isfile(os.path.join(destination_folder, output_name))
+        ):
+            if entry["mtime"] == source_mtime:
+                continue
+            if entry["hash"] == file_hash(source):
+                entry["mtime"] = source_mtime
+                continue
+        pending.append((output_name, source, pokemon_name, is_silhouette, source_mtime))
+
+    logger.info(f"{len(pending)} images to render, the rest are up to date.")
+    rendered = 0
+    try:
+        with ProcessPoolExecutor(workers, initializer=load_assets) as pool:
+            futures = {}
+            for output_name, source, pokemon_name, is_silhouette, mtime in pending:
+                destination = os.path.join(destination_folder, output_name)
+                future = pool.submit(
+                    render_sprite, source, pokemon_name, is_silhouette, destination
+                )
+                futures[future] = (output_name, source, pokemon_name, mtime)
+
+            for future in as_completed(futures):
+                output_name, source, pokemon_name, mtime = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Couldn't render {output_name}: {e}")
+                    manifest.pop(output_name, None)
+                    continue
+
+                manifest[output_name] = {
+                    "mtime": mtime,
+                    "hash": file_hash(source),
+                    "name": pokemon_name,
+                    "assets": assets_hash,
+                }
+                rendered += 1
+                if rendered % 100 == 0 or rendered == len(pending):
+                    logger.info(
+                        f"Rendered {rendered}/{len(pending)} images "
+                        f"({rendered / (time.time() - t0):.1f} images/s)."
+                    )
+    finally:
+        with open(f"{manifest_path}.tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    logger.info(f"Rendered {rendered} images in {time.time() - t0:.2f}s.")
+
+    packed = pack_sprites(destination_folder, atlas_path)
+    logger.info(f"Packed {packed} images into {atlas_path} in {time.time() - t0:.2f}s.")
@@ -0,0 +1,196 @@
+import datetime
+import itertools
+import random
+import time
+
+from peewee import chunked, fn
+
+from oakoakbot.db import (
+    SQLITE_MAX_VARIABLES,
+    db,
+    CaughtPokemon,
+    GroupsConfiguration,
+    Pokemon,
+    PokemonNatures,
+    Teams,
+)
+from oakoakbot.logger import get_logger
+
+logger = get_logger()
+
+POKEMON_CSV = "data/pokemon_data/pokemon.csv"
+NATURES_CSV = "data/pokemon_data/natures.csv"
+RARITY_WEIGHTS = {
+    "ultra-rare": 0.025,
+    "rare": 0.125,
+    "common": 0.35,
+    "ultra-common": 0.5,
+}
+SHINY_CHANCE = 1 / 10000
+ROWS_PER_TRANSACTION = 200000
+FAST_LOAD_PRAGMAS = {
+    "synchronous": "OFF",
+    "journal_mode": "MEMORY",
+    "cache_size": -256000,
+    "temp_store": "MEMORY",
+}
+CAUGHT_POKEMON_FIELDS = [
+    CaughtPokemon.team,
+    CaughtPokemon.pokemon,
+    CaughtPokemon.team_pokemon_id,
+    CaughtPokemon.catch_date,
+    CaughtPokemon.level,
+    CaughtPokemon.shiny,
+    CaughtPokemon.gender,
+    CaughtPokemon.ability,
+    CaughtPokemon.nature,
+    CaughtPokemon.hp_iv,
+    CaughtPokemon.attack_iv,
+    CaughtPokemon.defense_iv,
+    CaughtPokemon.special_attack_iv,
+    CaughtPokemon.special_defense_iv,
+    CaughtPokemon.speed_iv,
+]
+
+
+def bulk_insert(model, fields, rows):
+    """Insert rows in the biggest batches SQLite accepts, inside one transaction"""
+    batch_size = max(1, SQLITE_MAX_VARIABLES // len(fields))
+    with db.atomic():
+        for batch in chunked(rows, batch_size):
+            model.insert_many(batch, fields=fields).execute()
+
+
+def split_by_weights(total, weights):
+    """Split `total` into integer parts proportional to `weights`"""
+    weights_sum = sum(weights)
+    parts = [int(total * weight / weights_sum) for weight in weights]
+    for i in random.sample(range(len(parts)), total - sum(parts)):
+        parts[i] += 1
+    return parts
+
+
+def set_pragmas(pragmas):
+    previous = {}
+    for pragma, value in pragmas.items():
+        previous[pragma] = db.execute_sql(f"PRAGMA {pragma}").fetchone()[0]
+        db.execute_sql(f"PRAGMA {pragma} = {value}")
+    return previous
+
+
+def generate_catches(team_ids, team_sizes, pokemon, nature_ids):
+    """Yield caught Pokemon rows for every team, with the same stats distribution
+    as catches done on a group.
+    """
+    cum_weights = list(
+        itertools.accumulate(
+            RARITY_WEIGHTS[p.rarity_tier] / tier_size for p, tier_size in pokemon
+        )
+    )
+    pokemon = [p for p, _ in pokemon]
+    now = datetime.datetime.now()
+
+    for team_id, team_size in zip(team_ids, team_sizes):
+        catch_date = now - datetime.timedelta(days=random.uniform(0, 365))
+        average_gap = (now - catch_date) / (team_size + 1)
+        team_pokemon = random.choices(pokemon, cum_weights=cum_weights, k=team_size)
+        for team_pokemon_id, p in enumerate(team_pokemon):
+            catch_date += average_gap * random.uniform(0.5, 1.5)
+
+            ability = p.ability_1
+            if p.ability_2 and random.random() < 0.3:
+                ability = p.ability_2
+            if p.ability_hidden and random.random() < 0.1:
+                ability = p.ability_hidden
+
+            gender = {"mo": "male", "fo": "female", "uk": "unknown"}.get(
+                p.gender, "male" if random.random() < 0.5 else "female"
+            )
+            yield (
+                team_id,
+                p.id,
+                team_pokemon_id,
+                min(catch_date, now),
+                1,
+                random.random() < SHINY_CHANCE,
+                gender,
+                ability,
+                random.choice(nature_ids),
+                *[random.randint(0, 31) for _ in range(6)],
+            )
+
+
+def populate_database(
+    num_groups=100, num_teams=10000, num_catches=1000000, fast=False, seed=None
+):
+    """Fill the database with synthetic groups, teams and caught Pokemon.
+
+    Group activity and team sizes follow heavy-tailed distributions, as in
+    production: a few busy groups and dedicated collectors hold most of the catches.
+    With `fast`, durability PRAGMAs are relaxed during the load and restored after.
+    """
+    random.seed(seed)
+    t0 = time.time()
+
+    if not Pokemon.select().exists():
+        Pokemon.init_table_from_csv(POKEMON_CSV)
+    if not PokemonNatures.select().exists():
+        PokemonNatures.init_table_from_csv(NATURES_CSV)
+
+    previous_pragmas = set_pragmas(FAST_LOAD_PRAGMAS) if fast else {}
+    try:
+        # Groups, using ids below any real Telegram group id
+        lowest_group_id = GroupsConfiguration.select(
+            fn.MIN(GroupsConfiguration.group_id)
+        ).scalar()
+        first_group_id = min(-(10 ** 13), lowest_group_id or 0) - 1
+        group_ids = [first_group_id - i for i in range(num_groups)]
+        bulk_insert(
+            GroupsConfiguration,
+            [GroupsConfiguration.group_id],
+            [(group_id,) for group_id in group_ids],
+        )
+        logger.info(f"Inserted {num_groups} groups in {time.time() - t0:.2f}s.")
+
+        # Teams, spread over the groups following Zipf's law
+        group_sizes = split_by_weights(
+            num_teams, [1 / rank for rank in range(1, num_groups + 1)]
+        )
+        first_team_id = (Teams.select(fn.MAX(Teams.id)).scalar() or 0) + 1
+        teams = []
+        for group_id, group_size in zip(group_ids, group_sizes):
+            for user_id in random.sample(range(1, 10 * num_teams + 1), group_size):
+                teams.append((first_team_id + len(teams), user_id, group_id))
+        bulk_insert(Teams, [Teams.id, Teams.user_id, Teams.group_id], teams)
+        logger.info(f"Inserted {len(teams)} teams in {time.time() - t0:.2f}s.")
+
+        # Caught Pokemon, with Pareto distributed team sizes
+        team_sizes = split_by_weights(
+            num_catches, [random.paretovariate(1.2) for _ in teams]
+        )
+        spawnable = list(
+            Pokemon.select().where((Pokemon.mega == 0) & (Pokemon.enabled == 1))
+        )
+        tier_sizes = {}
+        for p in spawnable:
+            tier_sizes[p.rarity_tier] = tier_sizes.get(p.rarity_tier, 0) + 1
+        nature_ids = [n.id for n in PokemonNatures.select(PokemonNatures.id)]
+
+        catches = generate_catches(
+            [team_id for team_id, *_ in teams],
+            team_sizes,
+            [(p, tier_sizes[p.rarity_tier]) for p in spawnable],
+            nature_ids,
+        )
+        inserted = 0
+        for rows in chunked(catches, ROWS_PER_TRANSACTION):
+            bulk_insert(CaughtPokemon, CAUGHT_POKEMON_FIELDS, rows)
+            inserted += len(rows)
+            logger.info(
+                f"Inserted {inserted}/{num_catches} caught Pokemon "
+                f"({inserted / (time.time() - t0):.0f} rows/s)."
+            )
+    finally:
+        set_pragmas(previous_pragmas)
+
+    logger.info(f"Database populated in {time.time() - t0:.2f}s.")